@@ -1,69 +1,25 @@
 import streamlit as st
-import os
 import sqlite3
-import smtplib
-import threading
-import schedule
 from dotenv import load_dotenv
-import time as sleep_time
-from datetime import datetime, time, timezone
-from email.mime.multipart import MIMEMultipart
+from datetime import datetime
 from email_statistics import email_stats, start_periodic_task
 from outlook_api import *
 from gmail_api import *
 from templates import *
-from email.mime.text import MIMEText
+from send_engine import split_recipients
+from outbox import enqueue_campaign, individual_messages, campaign_progress, start_outbox_workers
+from scheduler import start_scheduler, notify_scheduled
+from recipients import ingest_csv, iter_list_recipients, list_size, list_columns, clean_recipients, add_suppressions
+from mail_merge import missing_variables, parallel_rendering
+from itertools import chain
 import pandas as pd
+from db import connection, transaction, add_write_listener, QUERY_CACHE_TTL, LIVE_CACHE_TTL, PROGRESS_CACHE_TTL
 
 
 # Load environment variables from .env file
 load_dotenv()
 
 
-# Initialize SQLite Database
-conn = sqlite3.connect("mass_mail.db", check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL,
-    is_active INTEGER DEFAULT 1,
-    is_superuser INTEGER DEFAULT 0
-)
-""")
-conn.commit()
-
-# Create email_activity table to track email counts
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS email_activity (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    email_count INTEGER NOT NULL DEFAULT 0,
-    date DATE NOT NULL,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-""")
-conn.commit()
-
-cursor.execute("""
-        CREATE TABLE IF NOT EXISTS scheduled_emails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            to_email TEXT,
-            cc_email TEXT,
-            bcc_email TEXT,
-            subject TEXT,
-            body TEXT,
-            signature TEXT,
-            schedule_time TIMESTAMP,
-            status TEXT DEFAULT 'Pending'
-        )
-    """)
-conn.commit()
-
-
-
 # Page Configuration
 #st.set_page_config(page_title="Mass Mail", layout="centered")
 
@@ -79,80 +35,76 @@ if "logged_in" not in st.session_state:
 def switch_page(page_name):
     st.session_state.page = page_name
 
-def get_template_by_id(template_id):
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM templates WHERE template_id=?', (template_id,))
-    template = cursor.fetchone()
-    conn.close()
-    return template
-
-# Updated Function to Send Email Using SMTP and track email count
-def send_email_smtp(subject, body, to_email, cc_email, bcc_email, reply_to_email, signature):
-    from_email = os.getenv('EMAIL_USER')  # SMTP email
-    from_password = os.getenv('EMAIL_PASS')  # Email password
-
-    # Ensure recipients are lists
-    to_recipients = [email.strip() for email in to_email.split(",") if email.strip()]
-    cc_recipients = [email.strip() for email in cc_email.split(",") if email.strip()]
-    bcc_recipients = [email.strip() for email in bcc_email.split(",") if email.strip()]
-    all_recipients = to_recipients + cc_recipients + bcc_recipients
-
-    if not all_recipients:
-        st.error("No valid recipients found. Please check your input.")
+def clean_form_recipients(to, cc, bcc):
+    """Dedupe, validate and suppression-filter the typed recipients, reporting what was dropped."""
+    to, cc, bcc, stats = clean_recipients(to, cc, bcc)
+    removed = stats["input"] - stats["kept"]
+    if removed:
+        st.info(f"Removed {removed} recipient(s): {stats['invalid']} invalid, "
+                f"{stats['duplicates']} duplicate, {stats['suppressed']} suppressed.")
+    return to, cc, bcc
+
+def is_templated(template_id, recipient_list_id):
+    """Stored templates and sends to an uploaded list are rendered with Jinja2; typed text is sent as written."""
+    return template_id is not None or bool(recipient_list_id)
+
+def check_merge_variables(subject, body, recipient_list_id, template_id=None, template_version=None):
+    """Report template variables the recipients can't fill before anything is queued."""
+    columns = list_columns(recipient_list_id) if recipient_list_id else []
+    missing, error = missing_variables(subject, body, columns, template_id, template_version,
+                                       is_templated(template_id, recipient_list_id))
+    if error:
+        st.error(error)
+        return False
+    if missing:
+        st.error(f"The template uses variables the recipients don't have: {', '.join(sorted(missing))}. "
+                 f"Available: {', '.join(['email'] + columns)}.")
+        return False
+    return True
+
+def queue_email(send_method, individual_copies, subject, body, to, cc, bcc, reply_to_email, signature,
+                recipient_list_id=None, template_id=None, template_version=None):
+    """Hand an email to the outbox workers and return right away.
+
+    An uploaded recipient list is streamed from the recipients table, one
+    copy per address, with its CSV columns available to the template.
+    """
+    # Authorize up front in the script thread; outbox workers never prompt
+    try:
+        if send_method == "Gmail API":
+            create_gmail_service()
+        elif send_method == "outlook" and not get_outlook_access_token(interactive=True):
+            st.write("Please authorize the application to send emails via Outlook.")
+            return
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
         return
 
-    # Set up the MIME message
-    msg = MIMEMultipart()
-    msg['From'] = from_email
-    msg['To'] = ", ".join(to_recipients)
-    msg['CC'] = ", ".join(cc_recipients)
-    msg['Subject'] = subject
-    if reply_to_email:
-        msg.add_header('Reply-To', reply_to_email)
-
-    msg.attach(MIMEText(body, 'plain'))
-
-    # Add signature
-    if signature:
-        msg.attach(MIMEText(f"\n\n--\n{signature}", 'plain'))
+    if recipient_list_id:
+        extra = split_recipients(to) + split_recipients(cc) + split_recipients(bcc)
+        messages = individual_messages(chain(iter_list_recipients(recipient_list_id), extra))
+        count = list_size(recipient_list_id) + len(extra)
+    elif send_method == "Gmail API" or individual_copies:
+        recipients = split_recipients(to) + split_recipients(cc) + split_recipients(bcc)
+        if not recipients:
+            st.error("No valid recipients found. Please check your input.")
+            return
+        messages = individual_messages(recipients)
+        count = len(recipients)
+    else:
+        messages = [(to, cc, bcc)]
+        count = 1
 
-    # Get user ID from session state
     user_id = st.session_state.get('user_id', None)
-
-    # Send email and update email count
     try:
-        # Connect to the SMTP server and send the email
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()  # Secure the connection
-        server.login(from_email, from_password)
-        server.sendmail(from_email, all_recipients, msg.as_string())
-        server.quit()
-
-        # Log email activity (daily count)
-        if user_id:
-            today = pd.to_datetime("today").date()  # Get today's date
-            cursor.execute("""
-            SELECT email_count FROM email_activity WHERE user_id = ? AND date = ? 
-            """, (user_id, today))
-            result = cursor.fetchone()
-
-            if result:
-                new_count = result[0] + len(all_recipients)  # Increment email count by the number of recipients
-                cursor.execute("""
-                UPDATE email_activity SET email_count = ? WHERE user_id = ? AND date = ? 
-                """, (new_count, user_id, today))
-            else:
-                cursor.execute("""
-                INSERT INTO email_activity (user_id, email_count, date) VALUES (?, ?, ?)
-                """, (user_id, len(all_recipients), today))
-
-            conn.commit()
-
-        st.success(f"Emails successfully sent to {len(all_recipients)} recipients.")
-
-    except Exception as e:
-        st.error(f"Error occurred while sending email: {e}")
+        campaign_id = enqueue_campaign(user_id, send_method, subject, body, messages, reply_to_email, signature,
+                                       template_id, template_version, is_templated(template_id, recipient_list_id),
+                                       prerender=bool(recipient_list_id) and parallel_rendering(count))
+    except sqlite3.Error as e:
+        st.error(f"Error queueing email: {e}")
+        return
+    st.session_state.last_campaign_id = campaign_id
+    st.success(f"Queued {count} email(s). They are being sent in the background.")
 
 # Function to logout the user
 def logout():
@@ -176,7 +128,6 @@ def new_page():
 # Email Dashboard Functionality
 def email_dashboard():
     st.markdown("<h3 style='text-align: center;'>Email Dashboard</h3>", unsafe_allow_html=True)
-    global send_method
     # Get user ID from session state
     user_id = st.session_state.get('user_id', None)
 
@@ -195,18 +146,27 @@ def email_dashboard():
 
     # Form Elements for recipients
     to = ""
+    recipient_list_id = None
     if st.session_state.email_input_method == "manual":
         to = st.text_input("To", placeholder="Enter recipient email(s) separated by commas")
     elif st.session_state.email_input_method == "csv":
         uploaded_file = st.file_uploader("Upload CSV", type=["csv"])
         if uploaded_file:
-            df = pd.read_csv(uploaded_file)
-            if "Email" in df.columns:
-                emails = df["Email"].dropna().tolist()
-                to = ", ".join(emails)
-                st.write(f"Loaded {len(emails)} emails from CSV.")
-            else:
-                st.error("CSV must contain a column named 'Email'")
+            # Ingest once per upload; reruns reuse the stored list
+            upload_key = (uploaded_file.name, uploaded_file.size)
+            if st.session_state.get("recipient_upload") != upload_key:
+                try:
+                    list_id, stats = ingest_csv(uploaded_file, user_id, uploaded_file.name)
+                    st.session_state.recipient_upload = upload_key
+                    st.session_state.recipient_list = (list_id, stats)
+                except ValueError as e:
+                    st.session_state.recipient_upload = None
+                    st.session_state.recipient_list = None
+                    st.error(str(e))
+            if st.session_state.get("recipient_list"):
+                recipient_list_id, stats = st.session_state.recipient_list
+                st.write(f"Loaded {stats['valid']} emails from CSV ({stats['invalid']} invalid, "
+                         f"{stats['duplicates']} duplicate and {stats['suppressed']} suppressed rows skipped).")
 
     cc = st.text_input("CC", placeholder="Enter CC email(s) (optional)")
     bcc = st.text_input("BCC", placeholder="Enter BCC email(s) (optional)")
@@ -216,10 +176,11 @@ def email_dashboard():
 
     subject = ""
     body = ""
+    template_id = template_version = None
 
     if use_template == "Yes":
-        # Get templates
-        templates = get_templates()
+        # Get template names (bodies are loaded only for the selected one)
+        templates = get_template_names()
         
         # Check if templates exist
         if not templates:
@@ -233,15 +194,8 @@ def email_dashboard():
                 create_template_button = st.form_submit_button("Create Template")
                 
                 if create_template_button:
-                    # Insert the new template into the database
-                    conn = sqlite3.connect('mass_mail.db')
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO templates (template_name, subject, body, created_by)
-                        VALUES (?, ?, ?, ?)
-                    """, (template_name, template_subject, template_body, user_id))
-                    conn.commit()
-                    conn.close()
+                    # Insert the new template into the database (and drop the cached listing)
+                    add_template(template_name, template_subject, template_body, user_id)
                     st.success("New template created successfully.")
                     st.rerun()  # Refresh the page to show the new template
         else:
@@ -259,6 +213,7 @@ def email_dashboard():
                 if template:
                     subject = template[2]  # Subject
                     body = template[3]  # Body
+                    template_id, template_version = template[0], template[5]
     else:
         # Manual entry
         subject = st.text_input("Title", value=subject, placeholder="Enter email subject")
@@ -267,6 +222,9 @@ def email_dashboard():
     signature = st.text_area("Signature", placeholder="Add your signature here...")
 
     send_method = st.selectbox("Send via", ["Gmail API", "SMTP", "outlook"])
+    individual_copies = False
+    if send_method in ("SMTP", "outlook"):
+        individual_copies = st.checkbox("Send each recipient their own copy")
 
 
     # Checkbox to schedule email for later
@@ -285,61 +243,63 @@ def email_dashboard():
     col1, col2 = st.columns([1, 1])
     with col1:
         if st.button("Send Email"):
-            if send_method == "Gmail API":
-                if to or cc or bcc:
-                    send_email_API(subject, body, to, cc, bcc, reply_to, signature)
-                else:
-                    st.error("Please enter at least one recipient email.")
-            elif send_method == "SMTP":
-                if to or cc or bcc:
-                    send_email_smtp(subject, body, to, cc, bcc, reply_to, signature)
-                else:
-                    st.error("Please enter at least one recipient email.")
-            elif send_method == "outlook":
-                if to or cc or bcc:
-                    try:
-                        full_body = body + "\n\n" + signature
-                        # Send email via Outlook
-                        result = send_email_via_outlook(to, subject, full_body, cc, bcc)
-                        if result is None:
-                            st.write("Please authorize the application to send emails via Outlook.")
-                        elif result["status"] == "success":
-                            st.success("Email sent successfully via Outlook.")
-                        else:
-                            st.error(f"Failed to send email via Outlook: {result['error_code']} - {result['error_message']}")
-                    except Exception as e:
-                        st.error(f"An error occurred while sending email via Outlook: {str(e)}")
-                else:
-                    st.error("Please enter at least one recipient email.")
+            to, cc, bcc = clean_form_recipients(to, cc, bcc)
+            if not (to or cc or bcc or recipient_list_id):
+                st.error("Please enter at least one recipient email.")
+            elif check_merge_variables(subject, body, recipient_list_id, template_id, template_version):
+                queue_email(send_method, individual_copies, subject, body, to, cc, bcc, reply_to, signature,
+                            recipient_list_id, template_id, template_version)
 
         else:
             with col2:
                 if st.button("Schedule Later"):
-                    if to or cc or bcc:
-                        if schedule_datetime and schedule_datetime > datetime.now():
-                            try:
-                                conn = sqlite3.connect('mass_mail.db')
-                                cursor = conn.cursor()
-                                cursor.execute("""
-                                               INSERT INTO scheduled_emails 
-                                               (user_id, to_email, cc_email, bcc_email, subject, body, signature, schedule_time)
-                                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                                               """, (user_id, to, cc, bcc, subject, body, signature, schedule_datetime))
-                                conn.commit()
-                                conn.close()
-                                st.success(f"Email scheduled for {schedule_datetime}.")
-                            except sqlite3.Error as e:
-                                st.error(f"Error scheduling email: {e}")
-                        else:
-                            st.error("Please select a valid date and time for scheduling.")
-                    else:
+                    to, cc, bcc = clean_form_recipients(to, cc, bcc)
+                    if not (to or cc or bcc or recipient_list_id):
                         st.error("Please enter at least one recipient email.")
+                    elif not (schedule_datetime and schedule_datetime > datetime.now()):
+                        st.error("Please select a valid date and time for scheduling.")
+                    elif check_merge_variables(subject, body, recipient_list_id, template_id, template_version):
+                        try:
+                            with connection() as conn:
+                                cursor = conn.execute("""
+                                               INSERT INTO scheduled_emails 
+                                               (user_id, to_email, cc_email, bcc_email, subject, body, signature, schedule_time, send_method,
+                                                recipient_list_id, templated)
+                                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                               """, (user_id, to, cc, bcc, subject, body, signature, schedule_datetime, send_method,
+                                                     recipient_list_id, int(is_templated(template_id, recipient_list_id))))
+                            email_id = cursor.lastrowid
+                            # Wake the scheduler so it sleeps until exactly this time
+                            notify_scheduled(email_id, schedule_datetime)
+                            st.success(f"Email scheduled for {schedule_datetime}.")
+                        except sqlite3.Error as e:
+                            st.error(f"Error scheduling email: {e}")
 
 
         
+    # Progress of the last queued send (workers keep going across reruns and reloads)
+    campaign_id = st.session_state.get("last_campaign_id")
+    if campaign_id:
+        counts = fetch_campaign_progress(campaign_id)
+        st.caption("Last send: " + ", ".join(f"{status}: {n}" for status, n in sorted(counts.items())))
+
     #if st.button("Email Status Board"):
         #st.session_state.page = "email_stats()"
 
+    # Addresses that asked not to be emailed again; every later send skips them
+    with st.expander("Unsubscribes"):
+        unsubscribe = st.text_area("Email(s) to unsubscribe", placeholder="Enter email(s) separated by commas")
+        if st.button("Unsubscribe"):
+            emails = split_recipients(unsubscribe)
+            if not emails:
+                st.error("Please enter at least one email.")
+            else:
+                try:
+                    add_suppressions(emails, "unsubscribed")
+                    st.success(f"{len(emails)} email(s) will no longer be sent to.")
+                except sqlite3.Error as e:
+                    st.error(f"Error saving unsubscribes: {e}")
+
     # Display a button for superusers to redirect to the superuser portal
     if st.session_state.is_superuser:
         st.markdown("<hr>", unsafe_allow_html=True)
@@ -352,39 +312,81 @@ def email_dashboard():
     if st.button("Logout"):
         logout()
 
+@st.cache_data(ttl=PROGRESS_CACHE_TTL)
+def fetch_campaign_progress(campaign_id):
+    return campaign_progress(campaign_id)
+
 # Fetch user data
+# Page reads are cached across reruns; the user write functions below clear them
+@st.cache_data(ttl=QUERY_CACHE_TTL)
 def fetch_users():
-    return pd.read_sql_query(
-        "SELECT id, username, is_active FROM users WHERE is_superuser = 0", conn
-    )
+    with connection() as conn:
+        return pd.read_sql_query("SELECT id, username, is_active FROM users WHERE is_superuser = 0", conn)
+
+@st.cache_data(ttl=QUERY_CACHE_TTL)
+def fetch_accounts(is_superuser):
+    with connection() as conn:
+        return pd.read_sql_query(
+            "SELECT id, username, password, is_active FROM users WHERE is_superuser = ?", conn, params=(is_superuser,)
+        )
+
+@st.cache_data(ttl=QUERY_CACHE_TTL)
+def fetch_inactive_users():
+    with connection() as conn:
+        return pd.read_sql_query("SELECT id, username FROM users WHERE is_active = 0 AND is_superuser = 0", conn)
+
+# Counts are written by the send workers, which clear this through the write listener below
+@st.cache_data(ttl=LIVE_CACHE_TTL)
+def fetch_email_activity(day):
+    with connection() as conn:
+        return pd.read_sql_query(""" 
+        SELECT u.username, ea.email_count, ea.date 
+        FROM email_activity ea
+        JOIN users u ON ea.user_id = u.id
+        WHERE ea.date = ? 
+        """, conn, params=(day,))
+
+def clear_live_cache():
+    """Drop cached counts and send progress; the background workers call this after they commit."""
+    fetch_email_activity.clear()
+    fetch_campaign_progress.clear()
+
+add_write_listener("dashboard", clear_live_cache)
+
+def clear_user_cache():
+    """Drop the cached user lists after a change to the users table."""
+    fetch_users.clear()
+    fetch_accounts.clear()
+    fetch_inactive_users.clear()
+    fetch_email_activity.clear()
 
 def update_user(user_id, new_username, new_password):
     try:
-        cursor.execute(
-            "UPDATE users SET username = ?, password = ? WHERE id = ?",
-            (new_username, new_password, user_id),
-        )
-        conn.commit()
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE users SET username = ?, password = ? WHERE id = ?",
+                (new_username, new_password, user_id),
+            )
+        clear_user_cache()
     except Exception as e:
         st.error(f"Error updating user: {e}")
-        conn.rollback()
 
 def delete_user(user_id):
     try:
-        cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        clear_user_cache()
     except Exception as e:
         st.error(f"Error deleting user: {e}")
-        conn.rollback()
 
 def update_user_status(user_id, new_status):
     try:
-        cursor.execute(
-            "UPDATE users SET is_active = ? WHERE id = ?", (new_status, user_id))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE users SET is_active = ? WHERE id = ?", (new_status, user_id))
+        clear_user_cache()
     except Exception as e:
         st.error(f"Error updating user status: {e}")
-        conn.rollback()
 
 def super_user_portal():
     if not st.session_state.logged_in or not st.session_state.is_superuser:
@@ -411,15 +413,9 @@ def super_user_portal():
             st.rerun()
 
     # Display user details excluding superusers
-    users_df = pd.read_sql_query(
-        "SELECT id, username, password, is_active FROM users WHERE is_superuser = 0",
-        conn
-    )
+    users_df = fetch_accounts(0)
 
-    super_users_df = pd.read_sql_query(
-        "SELECT id, username, password, is_active FROM users WHERE is_superuser = 1",
-        conn
-    )
+    super_users_df = fetch_accounts(1)
 
     col1, col2 = st.columns([15, 10])
     with col1:
@@ -441,18 +437,11 @@ def super_user_portal():
             st.warning("No superuser accounts available.")
 
     # Retrieve inactive users
-    inactive_users = pd.read_sql_query(
-        "SELECT id, username FROM users WHERE is_active = 0 AND is_superuser = 0", conn
-    )
+    inactive_users = fetch_inactive_users()
     
     # Display email activity of users
     st.subheader("Email Activity (Daily)")
-    email_activity_df = pd.read_sql_query(""" 
-    SELECT u.username, ea.email_count, ea.date 
-    FROM email_activity ea
-    JOIN users u ON ea.user_id = u.id
-    WHERE ea.date = ? 
-    """, conn, params=(pd.to_datetime("today").date(),))
+    email_activity_df = fetch_email_activity(pd.to_datetime("today").date())
 
     if not email_activity_df.empty:
         st.dataframe(email_activity_df)
@@ -495,54 +484,10 @@ def super_user_portal():
         logout()
 
 
-def process_scheduled_emails():
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    current_time = datetime.now(timezone.utc)  # Use UTC time for comparison
-
-    # Fetch all scheduled emails due for sending
-    cursor.execute("""
-        SELECT * FROM scheduled_emails 
-        WHERE schedule_time <= ? AND status = 'Pending'
-    """, (current_time,))
-    emails = cursor.fetchall()
-    print(f"Processing emails at {datetime.now()}")
-
-    for email in emails:
-        email_id, user_id, to_email, cc_email, bcc_email, subject, body, signature, schedule_time, status = email
-        try:
-            # Send email via selected method
-            if send_method == "Gmail API":
-                send_email_API(subject, body, to_email, cc_email, bcc_email, None, signature)
-            elif send_method == "SMTP":
-                send_email_smtp(subject, body, to_email, cc_email, bcc_email, None, signature)
-            elif send_method == "outlook":
-                full_body = body + "\n\n" + signature
-                result = send_email_via_outlook(to_email, subject, full_body, cc_email, bcc_email)
-                if result is None:
-                    print("Please authorize the application to send emails via Outlook.")
-                elif result["status"] != "success":
-                    raise Exception(f"Failed to send email via Outlook: {result['error_code']} - {result['error_message']}")
-
-            # Mark as sent
-            cursor.execute("UPDATE scheduled_emails SET status = 'Sent' WHERE id = ?", (email_id,))
-        except Exception as e:
-            # Mark as failed
-            cursor.execute("UPDATE scheduled_emails SET status = 'Failed' WHERE id = ?", (email_id,))
-            print(f"Error sending scheduled email: {e}")
-    
-    conn.commit()
-    conn.close()
-
-# Add scheduler to run every minute
-schedule.every(1).minutes.do(process_scheduled_emails)
-
-def start_scheduler():
-    while True:
-        schedule.run_pending()
-        sleep_time.sleep(1)
-
-threading.Thread(target=start_scheduler, daemon=True).start()
+start_scheduler()
+start_status_poller()
+start_outbox_workers()
+start_periodic_task()
 
 
 # Login Page Functionality
@@ -564,10 +509,11 @@ def login_page():
 
     if login_button:
         if username and password:
-            user = cursor.execute(
-                "SELECT id, username, password, is_active, is_superuser FROM users WHERE username = ? AND password = ?",
-                (username, password),
-            ).fetchone()
+            with connection() as conn:
+                user = conn.execute(
+                    "SELECT id, username, password, is_active, is_superuser FROM users WHERE username = ? AND password = ?",
+                    (username, password),
+                ).fetchone()
             if user:
                 if user[3] == 0:  # Check if user is inactive
                     st.error("Your account is inactive. Please contact a superuser for activation.")
@@ -611,11 +557,12 @@ def registration_page():
             if password == confirm_password:
                 is_superuser = 1 if user_type == "Superuser" else 0
                 try:
-                    cursor.execute(
-                        "INSERT INTO users (username, password, is_active, is_superuser) VALUES (?, ?, ?, ?)",
-                        (username, password, 1, is_superuser),  # Default is_active is 0 (inactive)
-                    )
-                    conn.commit()
+                    with connection() as conn:
+                        conn.execute(
+                            "INSERT INTO users (username, password, is_active, is_superuser) VALUES (?, ?, ?, ?)",
+                            (username, password, 1, is_superuser),  # Default is_active is 0 (inactive)
+                        )
+                    clear_user_cache()
                     st.success("Registration successful! Waiting for activation by a superuser.")
                 except sqlite3.IntegrityError:
                     st.error("Username already taken.")
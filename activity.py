@@ -0,0 +1,42 @@
+from datetime import date
+from db import connection, transaction, notify_writes
+
+
+def log_email_activity(user_id, count, provider=None):
+    """Add count to the user's (and provider's) daily email counter.
+
+    Each counter is bumped with a single UPSERT, so concurrent senders
+    neither lose increments nor create duplicate rows for the same day.
+    """
+    if not count:
+        return
+    today = date.today()
+    with transaction() as conn:
+        if user_id:
+            conn.execute("""
+            INSERT INTO email_activity (user_id, email_count, date) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, date) DO UPDATE SET email_count = email_count + excluded.email_count
+            """, (user_id, count, today))
+
+        if provider:
+            conn.execute("""
+            INSERT INTO provider_activity (provider, date, email_count) VALUES (?, ?, ?)
+            ON CONFLICT(provider, date) DO UPDATE SET email_count = email_count + excluded.email_count
+            """, (provider, today, count))
+    notify_writes()
+
+
+def daily_counts(user_id=None, provider=None):
+    """Return today's persisted (user count, provider count)."""
+    today = date.today()
+    user_count = provider_count = 0
+    with connection() as conn:
+        if user_id:
+            row = conn.execute("SELECT email_count FROM email_activity WHERE user_id = ? AND date = ?",
+                               (user_id, today)).fetchone()
+            user_count = row[0] if row else 0
+        if provider:
+            row = conn.execute("SELECT email_count FROM provider_activity WHERE provider = ? AND date = ?",
+                               (provider, today)).fetchone()
+            provider_count = row[0] if row else 0
+    return user_count, provider_count
@@ -0,0 +1,171 @@
+import os
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+DB_PATH = os.getenv("MASS_MAIL_DB", "mass_mail.db")
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "30000"))  # ms a writer waits for the lock before "database is locked"
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-16000"))  # page cache per connection; negative means KiB
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))  # connections shared by every thread in the process
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+# Streamlit page query caches (st.cache_data)
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "600"))  # seconds; users and templates, cleared by the app's own writes
+LIVE_CACHE_TTL = int(os.getenv("LIVE_CACHE_TTL", "30"))  # seconds; counts and stats, cleared by notify_writes() in this process
+PROGRESS_CACHE_TTL = int(os.getenv("PROGRESS_CACHE_TTL", "5"))  # seconds; progress of the last queued send
+
+_local = threading.local()
+_write_listeners = {}  # name -> callback run after background writers commit
+_write_listeners_lock = threading.Lock()
+
+
+def _connect():
+    # Autocommit: statements outside transaction() commit on their own instead of
+    # leaving an implicit transaction (and the write lock) open on a long-lived connection.
+    # Pooled connections move between threads, but only one thread uses a connection at a time
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT / 1000, isolation_level=None, check_same_thread=False)
+    # WAL lets readers (dashboard, stats) run alongside the scheduler and outbox writers
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+    # NORMAL is durable across application crashes in WAL mode and skips an fsync per commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    return conn
+
+
+class ConnectionPool:
+    """A bounded set of configured connections, checked out and back in by any thread.
+
+    Connections are opened (and their pragmas applied) on first demand, up
+    to max_size, and then reused for the life of the process, so threads
+    that come and go, such as Streamlit's per-rerun script threads, don't
+    pay for a new connection each time. The first connection opened applies
+    any pending schema migrations.
+    """
+
+    def __init__(self, max_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.timeout = timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def acquire(self):
+        """Take an idle connection, opening a new one if none is idle and the pool isn't full."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                # Imported here: migrations runs on a connection from this module
+                from migrations import migrate
+                conn = _connect()
+                migrate(conn)
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Give a connection back, rolling back anything its user left open."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._idle.append(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+
+pool = ConnectionPool()
+
+
+@contextmanager
+def connection():
+    """Check a pooled connection out for the duration of the block.
+
+    Nested blocks on the same thread (a transaction() inside a connection()
+    block, a helper called from either) share the outer block's connection,
+    which goes back to the pool when the outermost block ends. Hold it only
+    around database work, not across network calls.
+    """
+    if getattr(_local, "users", 0):
+        _local.users += 1
+        try:
+            yield _local.conn
+        finally:
+            _local.users -= 1
+        return
+
+    conn = pool.acquire()
+    _local.conn = conn
+    _local.users = 1
+    _local.depth = 0
+    try:
+        yield conn
+    finally:
+        _local.users = 0
+        _local.conn = None
+        pool.release(conn)
+
+
+@contextmanager
+def transaction(immediate=False):
+    """Run a block in a single transaction on a pooled connection.
+
+    Commits when the block finishes and rolls back if it raises. Nested
+    blocks join the outermost transaction. immediate=True takes the write
+    lock up front (BEGIN IMMEDIATE), for read-then-write blocks such as
+    claiming queued rows, so they wait on busy_timeout instead of failing
+    when they upgrade to a write.
+    """
+    with connection() as conn:
+        if _local.depth:
+            _local.depth += 1
+            try:
+                yield conn
+            finally:
+                _local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        _local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            _local.depth = 0
+
+
+def add_write_listener(name, callback):
+    """Run callback() whenever a background writer commits changes the pages show.
+
+    Pages register the .clear() of their cached queries here. Registering
+    a name again replaces its callback, so Streamlit reruns of a page don't
+    pile up listeners.
+    """
+    with _write_listeners_lock:
+        _write_listeners[name] = callback
+
+
+def notify_writes():
+    """Tell the listeners that sent_emails, outbox or activity rows changed; call after committing."""
+    with _write_listeners_lock:
+        callbacks = list(_write_listeners.values())
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            # A stale page cache must not fail the write that was just committed
+            print(f"Error running write listener: {e}")
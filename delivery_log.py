@@ -0,0 +1,89 @@
+import os
+import atexit
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from db import transaction, notify_writes
+
+
+load_dotenv()
+
+DELIVERY_LOG_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", "500"))  # buffered records that trigger a flush
+DELIVERY_LOG_FLUSH_INTERVAL = float(os.getenv("DELIVERY_LOG_FLUSH_INTERVAL", "2"))  # seconds a record may wait in the buffer
+
+INSERT_SENT_EMAIL = """
+    INSERT INTO sent_emails (sender, recipient, subject, message_id, status, updated_at, next_poll_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class DeliveryLog:
+    """Buffers sent_emails records and writes them in batches.
+
+    Transports append records as they send; a background thread writes the
+    buffer with one executemany in one transaction whenever
+    DELIVERY_LOG_BATCH_SIZE records are waiting or DELIVERY_LOG_FLUSH_INTERVAL
+    seconds have passed, instead of a commit (and fsync) per recipient.
+    Whatever is still buffered is written at interpreter exit.
+    """
+
+    def __init__(self):
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, sender, recipient, subject, message_id, status, next_poll_at=None):
+        """Buffer one delivery record, stamped with the current time."""
+        self.record_many([(sender, recipient, subject, message_id, status, next_poll_at)])
+
+    def record_many(self, records):
+        """Buffer (sender, recipient, subject, message_id, status, next_poll_at) records."""
+        now = datetime.now(timezone.utc)
+        rows = [(sender, recipient, subject, message_id, status, now, next_poll_at)
+                for sender, recipient, subject, message_id, status, next_poll_at in records]
+        if not rows:
+            return
+        with self._lock:
+            self._rows.extend(rows)
+            full = len(self._rows) >= DELIVERY_LOG_BATCH_SIZE
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="delivery-log-writer", daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write everything buffered so far. Returns the number of records written."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            try:
+                with transaction() as conn:
+                    conn.executemany(INSERT_SENT_EMAIL, rows)
+            except sqlite3.Error as e:
+                # Keep the records for the next flush rather than lose them
+                print(f"Error writing {len(rows)} delivery records: {e}")
+                with self._lock:
+                    self._rows[:0] = rows
+                return 0
+        notify_writes()
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(DELIVERY_LOG_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Delivery log writer error: {e}")
+
+
+delivery_log = DeliveryLog()
+# Daemon threads are cut off at exit, so write the tail of the buffer here
+atexit.register(delivery_log.flush)
@@ -1,42 +1,36 @@
 import streamlit as st
-import sqlite3
 import pandas as pd
 import plotly.graph_objects as go
-import sqlite3
 import schedule
 import time
 from gmail_api import *
 from datetime import datetime, timezone
+from activity import daily_counts
+from rate_limiter import USER_DAILY_LIMIT
+from db import connection, add_write_listener, LIVE_CACHE_TTL
 
-# The function to update statuses
-def update_statuses():
-    conn = sqlite3.connect("mass_mail.db")
-    cursor = conn.cursor()
+# Own scheduler so these jobs don't run on the email scheduler's thread
+status_schedule = schedule.Scheduler()
 
-    # Fetch message IDs with unknown status
-    cursor.execute("SELECT message_id FROM sent_emails WHERE status IS NULL OR status = 'unknown'")
-    message_ids = [row[0] for row in cursor.fetchall()]
-
-    service = create_gmail_service()
-    for message_id in message_ids:
-        status = get_email_status(service, message_id)
-        cursor.execute("UPDATE sent_emails SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE message_id = ?", (status, message_id))
-
-    conn.commit()
-    conn.close()
-
-# Function to schedule the status updates
+# Function to schedule the status updates (update_statuses lives in gmail_api)
 def schedule_status_updates():
-    schedule.every(1).hour.do(update_statuses)  # Run every hour
+    status_schedule.every(1).hour.do(update_statuses)  # Run every hour
 
     # Keep the schedule running
     while True:
-        schedule.run_pending()
+        try:
+            status_schedule.run_pending()
+        except Exception as e:
+            print(f"Error syncing email statuses: {e}")
         time.sleep(60)  # Sleep for a minute before checking again
 
 # Run the periodic task in a separate thread (to prevent blocking the main UI)
 import threading
+task_thread = None
 def start_periodic_task():
+    global task_thread
+    if task_thread is not None:
+        return
     task_thread = threading.Thread(target=schedule_status_updates)
     task_thread.daemon = True  # This allows the thread to exit when the main program exits
     task_thread.start()
@@ -50,58 +44,55 @@ def logout():
     st.session_state.is_superuser = False
     st.success("You have been logged out.Refresh to Login again")
 
-def email_stats():
-    # Connect to the database
-    conn = sqlite3.connect("mass_mail.db")
-    cursor = conn.cursor()
-
-    # Ensure required tables exist
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sent_emails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender TEXT,
-            recipient TEXT,
-            status TEXT,  -- 'delivered', 'inbox', 'spam'
-            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS mailbox (
-            id INTEGER PRIMARY KEY,
-            email TEXT,
-            account_health FLOAT,
-            deliverability FLOAT,
-            not_blacklisted BOOLEAN,
-            status BOOLEAN
-        )
-    """)
-
-    conn.commit()
-
-    # --- Fetch and calculate statistics ---
+@st.cache_data(ttl=LIVE_CACHE_TTL)
+def fetch_email_stats():
+    """(totals row, engagement per weekday) from the daily rollup (one row per day, sender and status)."""
     email_stats_query = """
         SELECT 
-            COUNT(*) AS total_sent,
-            SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) AS total_undelivered,
-            SUM(CASE WHEN status = 'inbox' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) AS inbox_percentage,
-            SUM(CASE WHEN status = 'spam' THEN 1 ELSE 0 END) * 100.0 / COUNT(*) AS spam_percentage
-        FROM sent_emails
+            SUM(email_count) AS total_sent,
+            SUM(CASE WHEN status = 'delivered' THEN email_count ELSE 0 END) AS total_undelivered,
+            SUM(CASE WHEN status = 'inbox' THEN email_count ELSE 0 END) AS inbox_count,
+            SUM(CASE WHEN status = 'spam' THEN email_count ELSE 0 END) AS spam_count
+        FROM sent_email_daily
+    """
+    engagement_data_query = """
+        SELECT strftime('%w', date) AS day_of_week, SUM(email_count) AS engagement
+        FROM sent_email_daily
+        WHERE date != ''
+        GROUP BY day_of_week
     """
-    stats = cursor.execute(email_stats_query).fetchone()
+    with connection() as conn:
+        return conn.execute(email_stats_query).fetchone(), conn.execute(engagement_data_query).fetchall()
+
+@st.cache_data(ttl=LIVE_CACHE_TTL)
+def fetch_sent_today(user_id):
+    return daily_counts(user_id=user_id)[0]
+
+def clear_stats_cache():
+    """Drop the cached stats; the send and status workers call this after they commit."""
+    fetch_email_stats.clear()
+    fetch_sent_today.clear()
+
+add_write_listener("email_stats", clear_stats_cache)
+
+def email_stats():
+    # --- Fetch and calculate statistics ---
+    # Cached, so reruns of the page don't query the database
+    stats, engagement_data = fetch_email_stats()
 
     # Fallback for empty database
     total_sent = stats[0] if stats[0] else 0
     total_undelivered = stats[1] if stats[1] else 0
-    inbox_percentage = stats[0] if stats[0] else 0
-    spam_percentage = stats[3] if stats[3] else 0
+    inbox_percentage = stats[2] * 100.0 / total_sent if total_sent else 0
+    spam_percentage = stats[3] * 100.0 / total_sent if total_sent else 0
 
-    ip=(inbox_percentage/total_sent)*100
+    ip = inbox_percentage
     # --- Dashboard Title ---
     st.title("Email Status Dashboard")
 
     # --- Daily Limit ---
-    st.info("Your Daily Email Limit is 100. Please Increase by 50 Per Day.")
+    sent_today = fetch_sent_today(st.session_state.get('user_id'))
+    st.info(f"Your Daily Email Limit is {USER_DAILY_LIMIT}. Sent today: {sent_today}.")
     if st.button("Edit Limit"):
         st.warning("Edit Limit functionality is not implemented yet.")
 
@@ -142,12 +133,6 @@ def email_stats():
 
     # --- Engagement Chart ---
     st.subheader("Engagement")
-    engagement_data_query = """
-        SELECT strftime('%w', updated_at) AS day_of_week, COUNT(*) AS engagement
-        FROM sent_emails
-        GROUP BY day_of_week
-    """
-    engagement_data = cursor.execute(engagement_data_query).fetchall()
 
     # Prepare engagement data for the week
     days = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
@@ -161,11 +146,9 @@ def email_stats():
     st.plotly_chart(fig2, use_container_width=True)
     user_id = st.session_state.get('user_id', None)
     if st.button("View Scheduled Emails"):
-        conn = sqlite3.connect('mass_mail.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM scheduled_emails WHERE user_id = ? ORDER BY schedule_time ASC", (user_id,))
-        scheduled_emails = cursor.fetchall()
-        conn.close()
+        with connection() as conn:
+            scheduled_emails = conn.execute("SELECT * FROM scheduled_emails WHERE user_id = ? ORDER BY schedule_time ASC",
+                                            (user_id,)).fetchall()
         if scheduled_emails:
             for email in scheduled_emails:
                 # Convert UTC timestamp to local time zone for display
@@ -5,188 +5,382 @@ from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
 import streamlit as st
 import pickle
-import base64
-import sqlite3
-from datetime import datetime, timezone
+import threading
+from datetime import datetime, timedelta, timezone
+from retry_policy import parse_retry_after
+from db import connection, transaction, notify_writes
+from delivery_log import delivery_log
 
 
 CREDENTIALS_FILE = "credentials.json"
+TOKEN_FILE = "token.pickle"
+SCOPES = ['https://www.googleapis.com/auth/gmail.send', 'https://www.googleapis.com/auth/gmail.readonly']
+TOKEN_REFRESH_MARGIN = int(os.getenv("GMAIL_TOKEN_REFRESH_MARGIN", "300"))  # refresh this many seconds before expiry
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))  # Gmail allows up to 100 calls per batch
+GMAIL_BATCH_RETRIES = int(os.getenv("GMAIL_BATCH_RETRIES", "3"))
+# HTTP statuses worth retrying inside a batch (rate limited / backend errors)
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+GMAIL_INLINE_RETRY_LIMIT = int(os.getenv("GMAIL_INLINE_RETRY_LIMIT", "60"))  # longest Retry-After (seconds) waited out in place
+STATUS_POLL_DELAY = int(os.getenv("STATUS_POLL_DELAY", "30"))  # seconds after sending before the first label check
+STATUS_POLL_INTERVAL = int(os.getenv("STATUS_POLL_INTERVAL", "15"))  # seconds between poller runs
+STATUS_POLL_BATCH = int(os.getenv("STATUS_POLL_BATCH", "500"))  # rows checked per poller run
+STATUS_POLL_MAX_ATTEMPTS = int(os.getenv("STATUS_POLL_MAX_ATTEMPTS", "6"))
 
 
 load_dotenv()
-# Connect to your SQLite database (mass_mail.db)
-conn = sqlite3.connect('mass_mail.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# SQL query to create the sent_emails table
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS sent_emails (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender TEXT,
-        recipient TEXT,
-        subject TEXT,
-        message_id TEXT,
-        status TEXT,  -- inbox, spam, not delivered
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-""")
 
-# Commit changes and close the connection
-conn.commit()
+class GmailClientCache:
+    """Process-wide cache of the Gmail credentials, sender address and built services.
 
-# Gmail API Authentication Flow for Desktop Apps
-def create_gmail_service():
-    SCOPES = ['https://www.googleapis.com/auth/gmail.send', 'https://www.googleapis.com/auth/gmail.readonly']
-    creds = None
+    Credentials are shared and refreshed proactively under a lock; the
+    service object is built once per thread because the underlying httplib2
+    transport is not thread-safe. token.pickle is only rewritten when the
+    token actually changes.
+    """
 
-    # Load credentials from the token.pickle file
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    else:
-        print("Token file not found.")
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._creds = None
+        self._saved_token = None
+        self._sender_email = None
+        self._generation = 0  # bumped whenever credentials are replaced
 
-    # If no credentials are available or they are expired, request the user to log in again
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())  # Refresh the token if expired
+    def _load(self):
+        if os.path.exists(TOKEN_FILE):
+            with open(TOKEN_FILE, 'rb') as token:
+                self._creds = pickle.load(token)
+            self._saved_token = getattr(self._creds, 'token', None)
         else:
-            flow = Flow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            flow.redirect_uri = "https://massmail-infosyshema.streamlit.app"  # Ensure this matches the production URL
+            print("Token file not found.")
+
+    def _save(self):
+        if self._creds is None or self._creds.token == self._saved_token:
+            return
+        with open(TOKEN_FILE, 'wb') as token:
+            pickle.dump(self._creds, token)
+        self._saved_token = self._creds.token
+
+    def _expiring(self):
+        expiry = self._creds.expiry  # naive UTC datetime
+        if expiry is None:
+            return False
+        remaining = expiry - datetime.now(timezone.utc).replace(tzinfo=None)
+        return remaining.total_seconds() < TOKEN_REFRESH_MARGIN
+
+    def credentials(self):
+        """Return valid credentials, refreshing them ahead of expiry; None if authorization is needed."""
+        with self._lock:
+            if self._creds is None:
+                self._load()
+            creds = self._creds
+            if creds is None:
+                return None
+            if (not creds.valid or self._expiring()) and creds.refresh_token:
+                creds.refresh(Request())
+                self._save()
+            return creds if creds.valid else None
+
+    def set_credentials(self, creds):
+        with self._lock:
+            self._creds = creds
+            self._sender_email = None
+            self._generation += 1
+            self._save()
+
+    def service(self):
+        creds = self.credentials()
+        if creds is None:
+            return None
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.service = build('gmail', 'v1', credentials=creds)
+            local.generation = self._generation
+        return local.service
+
+    def sender_email(self, service):
+        with self._lock:
+            if self._sender_email is None:
+                user_profile = service.users().getProfile(userId='me').execute()
+                self._sender_email = user_profile.get('emailAddress')
+                print(f"Authenticated sender email: {self._sender_email}")
+            return self._sender_email
+
+
+gmail_client = GmailClientCache()
+
+# Gmail API Authentication Flow for Desktop Apps
+def create_gmail_service():
+    service = gmail_client.service()
 
-            #flow.redirect_uri = st.experimental_get_query_params().get("redirect_uris", [""])[0]
-            auth_url, _ = flow.authorization_url(prompt="consent")
-            
-            st.write("Please authenticate with Gmail:")
-            st.markdown(f"[Click here to authenticate]({auth_url})")
+    # If no credentials are available or they can't be refreshed, request the user to log in again
+    if service is None:
+        flow = Flow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+        flow.redirect_uri = "https://massmail-infosyshema.streamlit.app"  # Ensure this matches the production URL
 
-            code = st.text_input("Paste the authorization code here:")
-            if code:
-                flow.fetch_token(code=code)
-                creds = flow.credentials
+        #flow.redirect_uri = st.experimental_get_query_params().get("redirect_uris", [""])[0]
+        auth_url, _ = flow.authorization_url(prompt="consent")
+        
+        st.write("Please authenticate with Gmail:")
+        st.markdown(f"[Click here to authenticate]({auth_url})")
 
+        code = st.text_input("Paste the authorization code here:")
+        if not code:
+            raise RuntimeError("Gmail authorization required.")
+        flow.fetch_token(code=code)
         # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        gmail_client.set_credentials(flow.credentials)
+        service = gmail_client.service()
 
-    service = build('gmail', 'v1', credentials=creds)
-    user_profile = service.users().getProfile(userId='me').execute()
-    sender_email = user_profile.get('emailAddress')
-    print(f"Authenticated sender email: {sender_email}")
+    return service, gmail_client.sender_email(service)
 
-    return service, sender_email
+def status_from_labels(labels):
+    if 'INBOX' in labels:
+        return "inbox"
+    elif 'SPAM' in labels:
+        return "spam"
+    elif 'SENT' in labels:
+        return "Sent"
+    elif 'TRASH' in labels:
+        return "Trash"
+    else:
+        return "not delivered"
 
 def get_email_status(service, message_id):
     try:
         message = service.users().messages().get(userId="me", id=message_id, format="metadata").execute()
-        print(f"Retrieved message with ID {message_id}: {message}")  # Added for debugging
-        # Wait for a brief moment for the labels to be updated (to ensure status is accurate)
-        time.sleep(2)  # Sleep for 2 seconds to allow Gmail to update the message status
-
         labels = message.get('labelIds', [])
         print(f"Labels for message ID {message_id}: {labels}")  # Added for debugging
-
-        if 'INBOX' in labels:
-            return "inbox"
-        elif 'SPAM' in labels:
-            return "spam"
-        elif 'SENT' in labels:
-            return "Sent"
-        elif 'TRASH' in labels:
-            return "Trash"
-        else:
-            return "not delivered"
+        return status_from_labels(labels)
     except HttpError as error:
         print(f"Error fetching message status for {message_id}: {error}")
         return "unknown"
 
-def send_email_API(subject, body, to_email, cc_email, bcc_email, reply_to_email, signature):
-    try:
-        service, sender_email = create_gmail_service()
-        
-        # Ensure recipients are lists
-        to_recipients = [email.strip() for email in to_email.split(",") if email.strip()]
-        cc_recipients = [email.strip() for email in cc_email.split(",") if email.strip()]
-        bcc_recipients = [email.strip() for email in bcc_email.split(",") if email.strip()]
-        all_recipients = to_recipients + cc_recipients + bcc_recipients
-        
-        if not all_recipients:
-            st.error("No valid recipients found. Please check your input.")
-            return
-        
-        # Set up the MIME message
-        msg = MIMEMultipart()
-        msg['Subject'] = subject
-        if reply_to_email:
-            msg.add_header('Reply-To', reply_to_email)
-        msg.attach(MIMEText(body, 'plain'))
-        
-        # Add signature
-        if signature:
-            msg.attach(MIMEText(f"\n\n--\n{signature}", 'plain'))
-
-        # Send individual emails to each recipient and log unique message ID
-        for recipient in all_recipients:
-            msg['To'] = recipient
-            message = MIMEText(body)
-            message['to'] = recipient
-            message['subject'] = subject
-            raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-
-            sent_message = service.users().messages().send(userId="me", body={'raw': raw}).execute()
-            message_id = sent_message['id']
-            print(f"Unique Message ID for {recipient}: {message_id}")
-            
-            time.sleep(2)
-            
-            # Get the status for the email
-            status = get_email_status(service, message_id)
-
-            # Store email data in the database with unique message_id for each recipient
-            cursor.execute("""
-                INSERT INTO sent_emails (sender, recipient, subject, message_id, status, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (sender_email, recipient, subject, message_id, status, datetime.now(timezone.utc)))
-            conn.commit()
-
-        st.success(f"Emails successfully sent to {len(all_recipients)} recipients.")
-
-    except Exception as error:
-        st.error(f"An error occurred: {error}")
+def get_email_statuses_batch(service, message_ids):
+    """Look up labels for many messages with batched messages.get calls.
 
-def update_statuses():
-    conn = sqlite3.connect("mass_mail.db")
-    cursor = conn.cursor()
+    Returns a dict of message_id -> status; messages whose lookup failed are
+    left out so the caller can try them again later.
+    """
+    statuses = {}
 
-    # Fetch message IDs and recipients with unknown status
-    cursor.execute("SELECT message_id, recipient FROM sent_emails WHERE status IS NULL OR status = 'unknown'")
-    rows = cursor.fetchall()
+    for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        chunk = message_ids[start:start + GMAIL_BATCH_SIZE]
 
-    # Log the IDs and recipients being processed
-    print(f"Message IDs and recipients to update: {[(row[0], row[1]) for row in rows]}")
+        def callback(request_id, response, exception, chunk=chunk):
+            message_id = chunk[int(request_id)]
+            if exception is None:
+                statuses[message_id] = status_from_labels(response.get('labelIds', []))
+            else:
+                print(f"Error fetching message status for {message_id}: {exception}")
 
-    service, _ = create_gmail_service()  # Create Gmail API service
+        batch = service.new_batch_http_request(callback=callback)
+        for i, message_id in enumerate(chunk):
+            batch.add(service.users().messages().get(userId="me", id=message_id, format="minimal"), request_id=str(i))
+        batch.execute()
 
-    for message_id, recipient in rows:
+    return statuses
+
+def send_messages_batch(service, messages):
+    """Send (recipient, raw) pairs through Gmail batch HTTP requests.
+
+    Messages are grouped GMAIL_BATCH_SIZE at a time and the per-message
+    callbacks are collected into one dict of recipient -> {'id': ...} or
+    {'error': ..., 'code': ..., 'retry_after': ...}. Calls that fail with a
+    retryable status are resent in a later batch, up to GMAIL_BATCH_RETRIES
+    times, unless Gmail asks for a longer wait than GMAIL_INLINE_RETRY_LIMIT;
+    those are left to the caller's retry queue.
+    """
+    results = {}
+    pending = list(messages)
+
+    for attempt in range(GMAIL_BATCH_RETRIES + 1):
+        retry = []
+        retry_after = 0
+
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            chunk = pending[start:start + GMAIL_BATCH_SIZE]
+
+            def callback(request_id, response, exception, chunk=chunk):
+                nonlocal retry_after
+                recipient, raw = chunk[int(request_id)]
+                if exception is None:
+                    results[recipient] = {'id': response['id']}
+                    return
+                resp = getattr(exception, 'resp', None)
+                status = getattr(resp, 'status', None)
+                wait = parse_retry_after(resp.get('retry-after')) if status is not None else None
+                if isinstance(exception, HttpError) and status in RETRYABLE_STATUSES:
+                    retry.append((recipient, raw))
+                    retry_after = max(retry_after, wait or 0)
+                results[recipient] = {'error': str(exception), 'code': status, 'retry_after': wait}
+
+            batch = service.new_batch_http_request(callback=callback)
+            for i, (recipient, raw) in enumerate(chunk):
+                batch.add(service.users().messages().send(userId="me", body={'raw': raw}), request_id=str(i))
+            batch.execute()
+
+        if not retry or attempt == GMAIL_BATCH_RETRIES or retry_after > GMAIL_INLINE_RETRY_LIMIT:
+            break
+        print(f"Retrying {len(retry)} Gmail sends after partial batch failure")
+        time.sleep(max(2 ** attempt, retry_after))
+        pending = retry
+
+    return results
+
+def deliver_gmail_messages(service, sender_email, subject, messages, subjects=None):
+    """Send (recipient, raw) pairs in batches and log the sent ones as pending.
+
+    Labels are filled in later by the status poller, so this runs at API
+    speed; the records go through the buffered delivery log. subjects maps
+    recipient -> subject for personalized messages. Returns the
+    per-recipient results from send_messages_batch.
+    """
+    results = send_messages_batch(service, messages)
+    subjects = subjects or {}
+    first_poll = datetime.now(timezone.utc) + timedelta(seconds=STATUS_POLL_DELAY)
+    delivery_log.record_many(
+        (sender_email, recipient, subjects.get(recipient, subject), result['id'], 'pending', first_poll)
+        for recipient, result in results.items() if 'id' in result
+    )
+    return results
+
+def _save_history_id(cursor, sender_email, history_id):
+    cursor.execute("""
+        INSERT INTO gmail_sync_state (sender, history_id, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(sender) DO UPDATE SET history_id = excluded.history_id, updated_at = excluded.updated_at
+    """, (sender_email, str(history_id), datetime.now(timezone.utc)))
+
+def _label_changes_since(service, history_id):
+    """Page through users.history.list and return (latest labels per message, new historyId)."""
+    labels = {}
+    page_token = None
+    while True:
+        response = service.users().history().list(
+            userId="me",
+            startHistoryId=history_id,
+            historyTypes=["labelAdded", "labelRemoved"],
+            pageToken=page_token,
+        ).execute()
+        # Records are in chronological order, so later ones overwrite earlier label sets
+        for record in response.get("history", []):
+            for change in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                message = change["message"]
+                labels[message["id"]] = message.get("labelIds", [])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return labels, response["historyId"]
+
+def _full_status_sync(service):
+    """Fallback when there is no usable historyId: batch-fetch every unresolved message."""
+    with connection() as conn:
+        rows = conn.execute("SELECT DISTINCT message_id FROM sent_emails WHERE status IS NULL OR status = 'unknown'").fetchall()
+    message_ids = [row[0] for row in rows if row[0]]
+    print(f"Full status sync for {len(message_ids)} messages")
+    return get_email_statuses_batch(service, message_ids)
+
+def update_statuses():
+    """Reconcile sent_emails statuses with Gmail incrementally via the History API.
+
+    Only label changes since the stored historyId are pulled and mapped back
+    to sent_emails by message_id. If there is no stored historyId, or Gmail
+    reports it as expired (404), unresolved rows are re-fetched with batched
+    messages.get calls and the current historyId becomes the new baseline.
+    """
+    # Background task: skip the run rather than prompt for authorization
+    service = gmail_client.service()
+    if service is None:
+        print("Gmail not authorized; skipping status sync.")
+        return
+    sender_email = gmail_client.sender_email(service)
+
+    with connection() as conn:
+        row = conn.execute("SELECT history_id FROM gmail_sync_state WHERE sender = ?", (sender_email,)).fetchone()
+    statuses = None
+    if row and row[0]:
         try:
-            # Get the status of the email for this message ID
-            status = get_email_status(service, message_id)
-            print(f"Updating message ID {message_id} with status: {status} for recipient: {recipient}")
-
-            # Update the status for the specific recipient
-            cursor.execute("""
-                UPDATE sent_emails
-                SET status = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE message_id = ? AND recipient = ?
-            """, (status, message_id, recipient))
-
-        except Exception as e:
-            print(f"Error updating status for {recipient}: {e}")
-
-    conn.commit()
-    conn.close()
+            labels, history_id = _label_changes_since(service, row[0])
+            statuses = {message_id: status_from_labels(ids) for message_id, ids in labels.items()}
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            print(f"History {row[0]} expired; falling back to a full status sync")
+
+    if statuses is None:
+        # Take the baseline before fetching so no change is missed in between
+        history_id = service.users().getProfile(userId="me").execute()["historyId"]
+        statuses = _full_status_sync(service)
+
+    now = datetime.now(timezone.utc)
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE sent_emails SET status = ?, updated_at = ? WHERE message_id = ?
+        """, [(status, now, message_id) for message_id, status in statuses.items()])
+        print(f"Status sync touched {cursor.rowcount} rows from {len(statuses)} Gmail changes")
+        _save_history_id(cursor, sender_email, history_id)
+    notify_writes()
+
+def poll_pending_statuses():
+    """Check labels for sent messages whose status is still pending.
+
+    Messages that can't be resolved yet are pushed back with exponential
+    backoff and marked 'unknown' after STATUS_POLL_MAX_ATTEMPTS tries.
+    """
+    now = datetime.now(timezone.utc)
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT message_id, poll_attempts FROM sent_emails
+            WHERE status = 'pending' AND next_poll_at <= ?
+            ORDER BY next_poll_at
+            LIMIT ?
+        """, (now, STATUS_POLL_BATCH)).fetchall()
+    if not rows:
+        return
+
+    # Background thread: skip the run rather than prompt for authorization
+    service = gmail_client.service()
+    if service is None:
+        return
+    statuses = get_email_statuses_batch(service, [message_id for message_id, _ in rows])
+
+    with transaction() as conn:
+        cursor = conn.cursor()
+        for message_id, attempts in rows:
+            status = statuses.get(message_id)
+            if status is not None:
+                cursor.execute("""
+                    UPDATE sent_emails SET status = ?, updated_at = ? WHERE message_id = ?
+                """, (status, now, message_id))
+            elif attempts + 1 >= STATUS_POLL_MAX_ATTEMPTS:
+                cursor.execute("""
+                    UPDATE sent_emails SET status = 'unknown', updated_at = ? WHERE message_id = ?
+                """, (now, message_id))
+            else:
+                next_poll = now + timedelta(seconds=STATUS_POLL_DELAY * 2 ** (attempts + 1))
+                cursor.execute("""
+                    UPDATE sent_emails SET poll_attempts = ?, next_poll_at = ? WHERE message_id = ?
+                """, (attempts + 1, next_poll, message_id))
+    notify_writes()
+
+_status_poller = None
+
+def start_status_poller():
+    """Start the background status poller once per process."""
+    global _status_poller
+    if _status_poller is not None:
+        return
+
+    def run():
+        while True:
+            try:
+                poll_pending_statuses()
+            except Exception as e:
+                print(f"Error polling email statuses: {e}")
+            time.sleep(STATUS_POLL_INTERVAL)
+
+    _status_poller = threading.Thread(target=run, daemon=True)
+    _status_poller.start()
@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from jinja2 import StrictUndefined, TemplateSyntaxError, meta
+from jinja2.sandbox import SandboxedEnvironment
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+MERGE_CACHE_SIZE = int(os.getenv("MERGE_CACHE_SIZE", "128"))  # compiled templates kept per process
+MERGE_PROCESSES = int(os.getenv("MERGE_PROCESSES", "0"))  # pre-render large lists in a process pool when > 1
+MERGE_PARALLEL_THRESHOLD = int(os.getenv("MERGE_PARALLEL_THRESHOLD", "5000"))  # list size before the pool is worth it
+# Always available to templates, whatever columns the list has
+BUILTIN_VARIABLES = {"email"}
+
+# Plain text mail: no HTML escaping; unknown variables raise instead of rendering as ""
+# Sandboxed: templates are written by dashboard users, so attribute access is
+# limited to safe data and anything reaching for Python internals raises SecurityError
+env = SandboxedEnvironment(undefined=StrictUndefined, autoescape=False, keep_trailing_newline=True)
+
+
+class CompiledTemplate:
+    """A subject/body pair compiled once, plus the variables it uses.
+
+    A template without variables still has to be rendered (comments,
+    {% if %} blocks, expressions), but its output is the same for every
+    recipient, so it is rendered once and reused.
+    """
+
+    def __init__(self, subject, body):
+        subject_ast = env.parse(subject or "")
+        body_ast = env.parse(body or "")
+        self.variables = meta.find_undeclared_variables(subject_ast) | meta.find_undeclared_variables(body_ast)
+        self.subject = env.from_string(subject or "")
+        self.body = env.from_string(body or "")
+        self._static = None
+
+    @property
+    def personalized(self):
+        return bool(self.variables)
+
+    def render(self, context):
+        if self.variables:
+            return self.subject.render(context), self.body.render(context)
+        if self._static is None:
+            self._static = (self.subject.render(), self.body.render())
+        return self._static
+
+
+class LiteralMessage:
+    """Free text typed into the dashboard, sent exactly as written."""
+
+    variables = frozenset()
+    personalized = False
+
+    def __init__(self, subject, body):
+        self.subject = subject or ""
+        self.body = body or ""
+
+    def render(self, context):
+        return self.subject, self.body
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cache_key(subject, body, template_id=None, version=None):
+    """(template_id, version) for stored templates; a content hash for text typed into the dashboard."""
+    if template_id is not None:
+        return ("template", template_id, version)
+    digest = hashlib.sha1(f"{subject}\0{body}".encode()).hexdigest()
+    return ("text", digest)
+
+
+def get_compiled(subject, body, template_id=None, version=None, templated=False):
+    """Compile a subject/body once per cache key; raises TemplateSyntaxError for broken templates.
+
+    Only stored templates (template_id given) and sends to an uploaded merge
+    list (templated=True) are Jinja2 templates. Anything else is free text
+    and comes back as a LiteralMessage, so "{{" in a typed body is just text.
+    """
+    if template_id is None and not templated:
+        return LiteralMessage(subject, body)
+    key = cache_key(subject, body, template_id, version)
+    with _cache_lock:
+        compiled = _cache.get(key)
+        if compiled is not None:
+            _cache.move_to_end(key)
+            return compiled
+    compiled = CompiledTemplate(subject, body)
+    with _cache_lock:
+        _cache[key] = compiled
+        while len(_cache) > MERGE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
+
+
+def missing_variables(subject, body, columns, template_id=None, version=None, templated=False):
+    """Variables the template uses that the recipient columns can't supply, checked before sending.
+
+    Returns (missing set, error message or None for a template that doesn't parse).
+    """
+    try:
+        compiled = get_compiled(subject, body, template_id, version, templated)
+    except TemplateSyntaxError as e:
+        return set(), f"Template error on line {e.lineno}: {e.message}"
+    return compiled.variables - BUILTIN_VARIABLES - set(columns), None
+
+
+def merge_context(email, fields):
+    """Template variables for one recipient: the CSV columns (JSON) plus email."""
+    context = json.loads(fields) if fields else {}
+    context["email"] = email
+    return context
+
+
+def render_rows(subject, body, rows, template_id=None, version=None, templated=False):
+    """Render (subject, body) for each (email, fields) row, in order, with the cached compiled template.
+
+    Free text comes back as written; a template without variables is
+    rendered once for all rows.
+    """
+    compiled = get_compiled(subject, body, template_id, version, templated)
+    if not compiled.personalized:
+        return [compiled.render({})] * len(rows)
+    return [compiled.render(merge_context(email, fields)) for email, fields in rows]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def parallel_rendering(count):
+    """True if a merge list of count recipients should be pre-rendered in the process pool."""
+    return MERGE_PROCESSES > 1 and count >= MERGE_PARALLEL_THRESHOLD
+
+
+def _process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: the dashboard process runs Streamlit, sender threads and pooled connections
+            _pool = ProcessPoolExecutor(max_workers=MERGE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _render_chunk(args):
+    subject, body, template_id, version, templated, rows = args
+    compiled = get_compiled(subject, body, template_id, version, templated)
+    rendered = []
+    for email, fields in rows:
+        try:
+            rendered.append(compiled.render(merge_context(email, fields)))
+        except Exception:
+            rendered.append(None)  # left for the send path, which reports the error per row
+    return rendered
+
+
+def render_rows_parallel(subject, body, rows, template_id=None, version=None, templated=False):
+    """Render (email, fields) rows across MERGE_PROCESSES spawned processes, in order.
+
+    Each process compiles the template once into its own cache. Rows that
+    fail to render come back as None.
+    """
+    size = max(1, -(-len(rows) // MERGE_PROCESSES))
+    chunks = [(subject, body, template_id, version, templated, rows[start:start + size])
+              for start in range(0, len(rows), size)]
+    return [rendered for chunk in _process_pool().map(_render_chunk, chunks) for rendered in chunk]
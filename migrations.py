@@ -0,0 +1,362 @@
+import threading
+
+
+# The database's schema version lives in PRAGMA user_version; migration N
+# (1-based position in MIGRATIONS) runs once, when user_version is below N.
+# Databases created before this runner are at version 0, so the baseline is
+# written to be safe on top of any earlier ad hoc schema.
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _add_column(conn, table, column, declaration):
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+def _baseline(conn):
+    """Every table the application uses, as the modules used to create them on import."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            is_active INTEGER DEFAULT 1,
+            is_superuser INTEGER DEFAULT 0
+        )
+    """)
+
+    # Per-user daily counters, one row per (user_id, date)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_activity (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            email_count INTEGER NOT NULL DEFAULT 0,
+            date DATE NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    """)
+    if "idx_email_activity_user_date" not in [row[1] for row in conn.execute("PRAGMA index_list(email_activity)")]:
+        # Older databases may hold several rows per user and day: fold them into the first one
+        conn.execute("""
+            UPDATE email_activity SET email_count = (
+                SELECT SUM(e.email_count) FROM email_activity e
+                WHERE e.user_id = email_activity.user_id AND e.date = email_activity.date
+            )
+            WHERE id IN (SELECT MIN(id) FROM email_activity GROUP BY user_id, date HAVING COUNT(*) > 1)
+        """)
+        conn.execute("DELETE FROM email_activity WHERE id NOT IN (SELECT MIN(id) FROM email_activity GROUP BY user_id, date)")
+        conn.execute("CREATE UNIQUE INDEX idx_email_activity_user_date ON email_activity(user_id, date)")
+    # Per-provider daily counters, so provider quotas survive restarts like the per-user ones
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS provider_activity (
+            provider TEXT NOT NULL,
+            date DATE NOT NULL,
+            email_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (provider, date)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sent_emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            recipient TEXT,
+            subject TEXT,
+            message_id TEXT,
+            status TEXT,  -- pending, inbox, spam, Sent, Trash, unknown, not delivered
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            poll_attempts INTEGER DEFAULT 0,
+            next_poll_at TIMESTAMP
+        )
+    """)
+    # Columns used by the deferred status poller
+    _add_column(conn, "sent_emails", "poll_attempts", "INTEGER DEFAULT 0")
+    _add_column(conn, "sent_emails", "next_poll_at", "TIMESTAMP")
+    # Last Gmail historyId reconciled into sent_emails, per sender account
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS gmail_sync_state (
+            sender TEXT PRIMARY KEY,
+            history_id TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mailbox (
+            id INTEGER PRIMARY KEY,
+            email TEXT,
+            account_health FLOAT,
+            deliverability FLOAT,
+            not_blacklisted BOOLEAN,
+            status BOOLEAN
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS templates (
+            template_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            template_name TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            created_by TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1
+        )
+    """)
+    # version is bumped on every edit so compiled mail merge templates are recompiled
+    _add_column(conn, "templates", "version", "INTEGER NOT NULL DEFAULT 1")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            to_email TEXT,
+            cc_email TEXT,
+            bcc_email TEXT,
+            subject TEXT,
+            body TEXT,
+            signature TEXT,
+            schedule_time TIMESTAMP,
+            status TEXT DEFAULT 'Pending',
+            send_method TEXT,
+            owner TEXT,
+            lease_expires_at TIMESTAMP,
+            next_attempt_at TIMESTAMP,
+            attempts INTEGER DEFAULT 0,
+            recipient_list_id INTEGER
+        )
+    """)
+    _add_column(conn, "scheduled_emails", "send_method", "TEXT")
+    # Lease columns: which scheduler process owns a 'Sending' row and until when
+    _add_column(conn, "scheduled_emails", "owner", "TEXT")
+    _add_column(conn, "scheduled_emails", "lease_expires_at", "TIMESTAMP")
+    # Set when a send was held back by a daily quota or failed with a transient error
+    _add_column(conn, "scheduled_emails", "next_attempt_at", "TIMESTAMP")
+    _add_column(conn, "scheduled_emails", "attempts", "INTEGER DEFAULT 0")
+    # Uploaded CSV lists are sent from the recipients table instead of to_email
+    _add_column(conn, "scheduled_emails", "recipient_list_id", "INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_status_time ON scheduled_emails(status, schedule_time)")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            provider TEXT NOT NULL,
+            subject TEXT,
+            body TEXT,
+            reply_to TEXT,
+            signature TEXT,
+            template_id INTEGER,
+            template_version INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            to_email TEXT,
+            cc_email TEXT,
+            bcc_email TEXT,
+            fields TEXT,  -- mail merge variables for this message as JSON
+            status TEXT NOT NULL DEFAULT 'queued',  -- queued, sending, sent, failed, retrying
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(campaign_id) REFERENCES outbox_campaigns(id)
+        )
+    """)
+    # Mail merge columns, for outboxes created before them
+    _add_column(conn, "outbox_campaigns", "template_id", "INTEGER")
+    _add_column(conn, "outbox_campaigns", "template_version", "INTEGER")
+    _add_column(conn, "outbox", "fields", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_attempt_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_campaign ON outbox(campaign_id, status)")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS recipient_lists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            total_rows INTEGER DEFAULT 0,
+            valid_count INTEGER DEFAULT 0,
+            invalid_count INTEGER DEFAULT 0,
+            columns TEXT,  -- JSON list of the CSV's extra columns, the list's mail merge variables
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS recipients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            list_id INTEGER NOT NULL,
+            email TEXT NOT NULL,
+            fields TEXT,  -- other CSV columns as a JSON object, for mail merge
+            FOREIGN KEY(list_id) REFERENCES recipient_lists(id)
+        )
+    """)
+    _add_column(conn, "recipient_lists", "columns", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_recipients_list ON recipients(list_id, id)")
+    # Addresses compare case-insensitively, so duplicates within a list are caught on lower(email)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_recipients_list_email ON recipients(list_id, lower(email))")
+    # Addresses we must not send to (bounces, unsubscribes), keyed by the lowercased address
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS suppressions (
+            email TEXT PRIMARY KEY,
+            reason TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+
+
+def _consistent_sent_emails(conn):
+    """Bring a sent_emails table created by the old stats page (sent_at, no subject/message_id) in line."""
+    columns = _columns(conn, "sent_emails")
+    _add_column(conn, "sent_emails", "subject", "TEXT")
+    _add_column(conn, "sent_emails", "message_id", "TEXT")
+    # ALTER TABLE can't add a CURRENT_TIMESTAMP default, so old rows take their sent_at
+    _add_column(conn, "sent_emails", "updated_at", "TIMESTAMP")
+    if "sent_at" in columns:
+        conn.execute("UPDATE sent_emails SET updated_at = sent_at WHERE updated_at IS NULL")
+
+
+def _hot_path_indexes(conn):
+    """Indexes for the status poller, per-message status updates, the stats page and the scheduler."""
+    # status first, then next_poll_at for the pending poller's range and ORDER BY
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_emails_status ON sent_emails(status, next_poll_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_emails_message_id ON sent_emails(message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_emails_updated_at ON sent_emails(updated_at)")
+    # (status, schedule_time) for the scheduler's claim already comes with the baseline
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_user ON scheduled_emails(user_id)")
+
+
+def _sent_email_rollups(conn):
+    """Daily sent_emails counts per sender and status, kept current by triggers, for the stats page.
+
+    A record counts towards the day of its updated_at, like the engagement
+    chart always grouped it; a status update (which also moves updated_at)
+    moves the record from its old (day, status) to the new one in the
+    same transaction as the write.
+    """
+    # '' stands in for NULL, which a WITHOUT ROWID primary key can't hold
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sent_email_daily (
+            date TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            status TEXT NOT NULL,
+            email_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, sender, status)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS sent_emails_rollup_insert AFTER INSERT ON sent_emails
+        BEGIN
+            INSERT INTO sent_email_daily (date, sender, status, email_count)
+            VALUES (COALESCE(date(NEW.updated_at), ''), COALESCE(NEW.sender, ''), COALESCE(NEW.status, ''), 1)
+            ON CONFLICT(date, sender, status) DO UPDATE SET email_count = email_count + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS sent_emails_rollup_delete AFTER DELETE ON sent_emails
+        BEGIN
+            UPDATE sent_email_daily SET email_count = email_count - 1
+            WHERE date = COALESCE(date(OLD.updated_at), '') AND sender = COALESCE(OLD.sender, '')
+              AND status = COALESCE(OLD.status, '');
+        END
+    """)
+    # Poller bookkeeping (poll_attempts, next_poll_at) doesn't touch the rollup
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS sent_emails_rollup_update AFTER UPDATE OF status, updated_at, sender ON sent_emails
+        WHEN OLD.status IS NOT NEW.status OR OLD.sender IS NOT NEW.sender
+          OR date(OLD.updated_at) IS NOT date(NEW.updated_at)
+        BEGIN
+            UPDATE sent_email_daily SET email_count = email_count - 1
+            WHERE date = COALESCE(date(OLD.updated_at), '') AND sender = COALESCE(OLD.sender, '')
+              AND status = COALESCE(OLD.status, '');
+            INSERT INTO sent_email_daily (date, sender, status, email_count)
+            VALUES (COALESCE(date(NEW.updated_at), ''), COALESCE(NEW.sender, ''), COALESCE(NEW.status, ''), 1)
+            ON CONFLICT(date, sender, status) DO UPDATE SET email_count = email_count + 1;
+        END
+    """)
+    # Backfill from the history so far
+    conn.execute("DELETE FROM sent_email_daily")
+    conn.execute("""
+        INSERT INTO sent_email_daily (date, sender, status, email_count)
+        SELECT COALESCE(date(updated_at), ''), COALESCE(sender, ''), COALESCE(status, ''), COUNT(*)
+        FROM sent_emails
+        GROUP BY 1, 2, 3
+    """)
+
+
+def _templated_messages(conn):
+    """Record which queued and scheduled sends are Jinja2 templates; everything else is sent as typed."""
+    _add_column(conn, "outbox_campaigns", "templated", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "scheduled_emails", "templated", "INTEGER NOT NULL DEFAULT 0")
+    # Rows from before the flag keep rendering if they came from a stored template or a merge list
+    conn.execute("""
+        UPDATE outbox_campaigns SET templated = 1
+        WHERE template_id IS NOT NULL OR id IN (SELECT campaign_id FROM outbox WHERE fields IS NOT NULL)
+    """)
+    conn.execute("UPDATE scheduled_emails SET templated = 1 WHERE recipient_list_id IS NOT NULL")
+
+
+
+def _outbox_leases(conn):
+    """Owner and lease columns for outbox rows in 'sending', renewed by the worker process sending them."""
+    _add_column(conn, "outbox", "owner", "TEXT")
+    _add_column(conn, "outbox", "lease_expires_at", "TIMESTAMP")
+
+
+def _prerendered_messages(conn):
+    """Per-message subject and body for merge lists rendered in the process pool when they were queued."""
+    _add_column(conn, "outbox", "subject", "TEXT")
+    _add_column(conn, "outbox", "body", "TEXT")
+
+
+def _scheduled_campaigns(conn):
+    """The outbox campaign a scheduled list send was handed to, so a reclaimed row resumes it instead of starting over."""
+    _add_column(conn, "scheduled_emails", "campaign_id", "INTEGER")
+    # Resuming skips the addresses the campaign already holds
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_campaign_to ON outbox(campaign_id, to_email)")
+
+
+MIGRATIONS = [
+    _baseline,
+    _consistent_sent_emails,
+    _hot_path_indexes,
+    _sent_email_rollups,
+    _templated_messages,
+    _outbox_leases,
+    _prerendered_messages,
+    _scheduled_campaigns,
+]
+
+_lock = threading.Lock()
+_done = False
+
+
+def migrate(conn):
+    """Apply pending migrations once per process; returns the schema version.
+
+    Runs under BEGIN IMMEDIATE, so when several processes start together
+    one applies the migrations and the others wait and then find nothing
+    to do. Each migration and its user_version bump commit together.
+    """
+    global _done
+    with _lock:
+        if _done:
+            return len(MIGRATIONS)
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] < version:
+                    migration(conn)
+                    conn.execute(f"PRAGMA user_version = {version}")
+                    print(f"Applied schema migration {version}: {migration.__name__.strip('_')}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        _done = True
+        return len(MIGRATIONS)
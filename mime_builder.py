@@ -0,0 +1,83 @@
+import base64
+from functools import lru_cache
+from email.utils import formataddr, parseaddr
+from email.policy import compat32
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+
+SHARED_MESSAGE_CACHE_SIZE = 32  # distinct (sender, subject, body, ...) messages kept encoded
+# The default (compat32) policy the MIME classes already use, with SMTP line endings
+CRLF_POLICY = compat32.clone(linesep="\r\n")
+
+
+def _address_header(name, addresses):
+    """One CRLF-terminated address header line, built without the email package's generator."""
+    value = ", ".join(addresses)
+    if not value.isascii():
+        # RFC 2047-encode display names; the addresses themselves stay as they are
+        addresses = [formataddr(parseaddr(address), "utf-8") for address in addresses]
+        value = ", ".join(addresses)
+    if len(value) > 900:
+        # Fold long lists, one address per line, to stay under the 998 byte line limit
+        value = ",\r\n ".join(addresses)
+    return f"{name}: {value}\r\n".encode("utf-8")
+
+
+class SharedMessage:
+    """A message whose body is MIME-encoded once and reused for every recipient.
+
+    Only the To/CC headers differ between copies, so the generated bytes
+    are split into those per-recipient headers and a shared remainder
+    (From, Subject, MIME headers and the encoded parts). A copy is the
+    recipient's header lines followed by the shared bytes, and the Gmail
+    API form is the base64 of both, with the shared part's base64 computed
+    once as well.
+    """
+
+    def __init__(self, from_email, subject, body, reply_to_email=None, signature=""):
+        # Same structure the dashboard has always sent: body part plus optional signature part
+        msg = MIMEMultipart()
+        msg['From'] = from_email
+        msg['Subject'] = subject
+        if reply_to_email:
+            msg.add_header('Reply-To', reply_to_email)
+        msg.attach(MIMEText(body, 'plain'))
+        if signature:
+            msg.attach(MIMEText(f"\n\n--\n{signature}", 'plain'))
+        # CRLF line endings so the bytes can go to SMTP DATA as they are
+        self.shared = msg.as_bytes(policy=CRLF_POLICY)
+        self._shared_b64 = None
+
+    def _prefix(self, to_recipients, cc_recipients=None):
+        prefix = _address_header("To", to_recipients)
+        if cc_recipients:
+            prefix += _address_header("CC", cc_recipients)
+        return prefix
+
+    def as_bytes(self, to_recipients, cc_recipients=None):
+        """The full message for one copy, ready for SMTP DATA."""
+        return self._prefix(to_recipients, cc_recipients) + self.shared
+
+    def gmail_raw(self, to_recipients, cc_recipients=None):
+        """The base64url 'raw' field for the Gmail API.
+
+        base64 maps every 3 input bytes to 4 output characters, so if the
+        per-recipient headers are a multiple of 3 bytes long, the encoding of
+        the whole message is the encoding of the headers followed by the
+        (cached) encoding of the shared bytes. The headers are padded with
+        trailing spaces, which are folding whitespace and ignored by readers.
+        """
+        prefix = self._prefix(to_recipients, cc_recipients)
+        padding = -len(prefix) % 3
+        if padding:
+            prefix = prefix[:-2] + b" " * padding + b"\r\n"
+        if self._shared_b64 is None:
+            self._shared_b64 = base64.urlsafe_b64encode(self.shared).decode()
+        return base64.urlsafe_b64encode(prefix).decode() + self._shared_b64
+
+
+@lru_cache(maxsize=SHARED_MESSAGE_CACHE_SIZE)
+def shared_message(from_email, subject, body, reply_to_email=None, signature=""):
+    """A SharedMessage, reused across units of the same campaign."""
+    return SharedMessage(from_email, subject, body, reply_to_email, signature)
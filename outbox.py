@@ -0,0 +1,406 @@
+import os
+import uuid
+import socket
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from db import connection, transaction, notify_writes
+from send_engine import PROVIDER_UNIT_SIZE, run_campaign, send_shared, split_recipients, record_undelivered
+from mail_merge import get_compiled, render_rows, render_rows_parallel, merge_context
+from activity import log_email_activity
+from retry_policy import RETRY_MAX_ATTEMPTS, classify_result, classify_exception, backoff_delay
+
+
+load_dotenv()
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))  # claiming threads per process; sends stay within PROVIDER_CONCURRENCY
+OUTBOX_CLAIM_SIZE = int(os.getenv("OUTBOX_CLAIM_SIZE", "50"))  # messages claimed per worker pass
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", str(RETRY_MAX_ATTEMPTS)))
+OUTBOX_LEASE_DURATION = int(os.getenv("OUTBOX_LEASE_DURATION", "300"))  # seconds a claim stays valid without renewal
+OUTBOX_LEASE_RENEW_INTERVAL = OUTBOX_LEASE_DURATION / 3
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))  # seconds between checks when idle
+ENQUEUE_CHUNK = 1000  # rows per executemany and commit while enqueueing
+
+# Message states: queued -> sending -> sent | retrying -> sending ... | failed
+# Only transient errors (throttling, 4xx SMTP replies, 5xx HTTP, network) are retried
+# A message held back by a daily quota goes back to queued without using up an attempt
+# A 'sending' row is owned by the process that claimed it (owner) until lease_expires_at;
+# the owner renews the lease while it works, so only rows of a dead process expire
+
+# Identifies this process in outbox.owner
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+_in_flight = set()  # ids claimed by this process and not yet resolved
+_in_flight_lock = threading.Lock()
+
+
+def enqueue_campaign(user_id, provider, subject, body, messages, reply_to=None, signature="",
+                     template_id=None, template_version=None, templated=False, prerender=False,
+                     campaign_id=None, on_created=None):
+    """Store a campaign and its messages in the outbox and wake the workers.
+
+    messages is an iterable of (to, cc, bcc) or (to, cc, bcc, fields)
+    tuples, one per message, where fields is the recipient's mail merge
+    variables as JSON; it is consumed in chunks so long recipient lists
+    never sit in memory at once. subject and body are Jinja2 templates,
+    rendered per message when it is sent, if templated is set (a stored
+    template or a merge list); otherwise they are sent as written. With
+    prerender set (see mail_merge.parallel_rendering), a personalized
+    template is instead rendered for each individual copy here, across the
+    merge process pool, and the result stored with the row.
+    Rows are committed ENQUEUE_CHUNK at a time, so a long list never holds
+    the write lock for the whole enqueue, and workers start sending the
+    first chunks while later ones are still being added. on_created(conn,
+    campaign_id) runs in the transaction that creates the campaign, so a
+    caller can record the hand-off atomically. Passing the campaign_id of
+    an enqueue that was cut short resumes it: messages whose To address the
+    campaign already holds are skipped. Returns the campaign id.
+    """
+    resume = campaign_id is not None
+    if not resume:
+        with transaction() as conn:
+            campaign_id = conn.execute("""
+                INSERT INTO outbox_campaigns (user_id, provider, subject, body, reply_to, signature, template_id,
+                                              template_version, templated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, provider, subject, body, reply_to, signature, template_id, template_version,
+                  int(templated))).lastrowid
+            if on_created is not None:
+                on_created(conn, campaign_id)
+
+    if prerender:
+        try:
+            prerender = get_compiled(subject, body, template_id, template_version, templated).personalized
+        except Exception:
+            prerender = False  # a broken template fails each row when it is sent
+    template = (subject, body, template_id, template_version, templated) if prerender else None
+    chunk = []
+    for message in messages:
+        to, cc, bcc = message[:3]
+        chunk.append((campaign_id, to, cc, bcc, message[3] if len(message) > 3 else None))
+        if len(chunk) >= ENQUEUE_CHUNK:
+            _enqueue_chunk(chunk, template, resume)
+            chunk = []
+    if chunk:
+        _enqueue_chunk(chunk, template, resume)
+    return campaign_id
+
+
+def _enqueue_chunk(rows, template=None, resume=False):
+    """Insert and commit one chunk of (campaign_id, to, cc, bcc, fields) rows, then wake the workers.
+
+    With template (subject, body, template_id, version, templated), individual
+    copies are rendered first; rows left unrendered are rendered when sent.
+    When resuming, rows whose To address the campaign already has are skipped.
+    """
+    rendered = {}
+    if template is not None:
+        individual = [i for i, row in enumerate(rows) if _is_individual(row[1:4])]
+        contents = render_rows_parallel(template[0], template[1], [(rows[i][1].strip(), rows[i][4]) for i in individual],
+                                        *template[2:])
+        rendered = {i: content for i, content in zip(individual, contents) if content is not None}
+    values = [(*row, *rendered.get(i, (None, None))) for i, row in enumerate(rows)]
+    with transaction() as conn:
+        if resume:
+            conn.executemany("""
+                INSERT INTO outbox (campaign_id, to_email, cc_email, bcc_email, fields, subject, body)
+                SELECT ?, ?, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM outbox WHERE campaign_id = ? AND to_email = ?)
+            """, [(*value, value[0], value[1]) for value in values])
+        else:
+            conn.executemany("""
+                INSERT INTO outbox (campaign_id, to_email, cc_email, bcc_email, fields, subject, body) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, values)
+    _wakeup.set()
+
+
+def individual_messages(recipients):
+    """(to, cc, bcc) tuples giving every recipient their own copy.
+
+    recipients may also be (email, fields) pairs, which keep their mail merge fields.
+    """
+    for recipient in recipients:
+        if isinstance(recipient, tuple):
+            yield (recipient[0], "", "", recipient[1])
+        else:
+            yield (recipient, "", "")
+
+
+def campaign_progress(campaign_id):
+    """Return a dict of status -> message count for a campaign."""
+    with connection() as conn:
+        rows = conn.execute("SELECT status, COUNT(*) FROM outbox WHERE campaign_id = ? GROUP BY status", (campaign_id,)).fetchall()
+    return dict(rows)
+
+
+def _lease_expiry():
+    return datetime.now(timezone.utc) + timedelta(seconds=OUTBOX_LEASE_DURATION)
+
+
+def _claim(cursor, now):
+    cursor.execute("""
+        UPDATE outbox SET status = 'sending', attempts = attempts + 1, owner = ?, lease_expires_at = ?, updated_at = ?
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE status IN ('queued', 'retrying') AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+            ORDER BY id
+            LIMIT ?
+        )
+        RETURNING id, campaign_id, to_email, cc_email, bcc_email, attempts, fields, subject, body
+    """, (WORKER_ID, _lease_expiry(), now, now, OUTBOX_CLAIM_SIZE))
+    return cursor.fetchall()
+
+
+def _requeue_stale(cursor, now):
+    """Put back messages whose owner stopped renewing their lease (it died mid-send)."""
+    # Rows claimed before leases existed have none; they fall back to their age
+    cursor.execute("""
+        UPDATE outbox SET status = 'retrying', owner = NULL, lease_expires_at = NULL, next_attempt_at = NULL, updated_at = ?
+        WHERE status = 'sending'
+          AND (lease_expires_at < ? OR (lease_expires_at IS NULL AND updated_at <= ?))
+    """, (now, now, now - timedelta(seconds=OUTBOX_LEASE_DURATION)))
+
+
+def _renew_leases():
+    """Keep the leases of rows this process is still working on from running out."""
+    while True:
+        threading.Event().wait(OUTBOX_LEASE_RENEW_INTERVAL)
+        with _in_flight_lock:
+            ids = list(_in_flight)
+        if not ids:
+            continue
+        try:
+            expiry = _lease_expiry()
+            with transaction() as conn:
+                conn.executemany("UPDATE outbox SET lease_expires_at = ? WHERE id = ? AND owner = ? AND status = 'sending'",
+                                 [(expiry, row_id, WORKER_ID) for row_id in ids])
+        except sqlite3.Error as e:
+            print(f"Error renewing outbox leases: {e}")
+
+
+def _failure(provider, result):
+    """Outcome for a failed result: 'retry' if the error is transient, else 'failed'."""
+    transient, retry_after = classify_result(provider, result)
+    return ("retry" if transient else "failed", str(result["detail"]), 0, retry_after)
+
+
+def _is_final(outcome, row):
+    """True if a failed outcome won't be retried: a permanent error, or the row's last attempt."""
+    return outcome[0] == "failed" or (outcome[0] == "retry" and row[5] >= OUTBOX_MAX_ATTEMPTS)
+
+
+def _is_individual(addresses):
+    """True for a lone To address with no CC/BCC, which can be batched with the campaign's other copies."""
+    to, cc, bcc = addresses
+    return not cc and not bcc and "," not in (to or "")
+
+
+def _render_unit(compiled, subject, body, template_id, template_version, templated, unit, outcomes):
+    """Personalize a unit of individual rows; rows that fail to render are recorded as failed.
+
+    Rows pre-rendered when they were queued keep their stored subject and
+    body. Returns the rows that rendered and their (recipient, subject,
+    body) messages.
+    """
+    ready = [row for row in unit if row[7] is not None]
+    kept, messages = _render_now(compiled, subject, body, template_id, template_version, templated,
+                                 [row for row in unit if row[7] is None], outcomes)
+    return ready + kept, [(row[2].strip(), row[7], row[8]) for row in ready] + messages
+
+
+def _render_now(compiled, subject, body, template_id, template_version, templated, unit, outcomes):
+    if not unit:
+        return [], []
+    recipients = [row[2].strip() for row in unit]
+    try:
+        rendered = render_rows(subject, body, [(recipient, row[6]) for recipient, row in zip(recipients, unit)],
+                               template_id, template_version, templated)
+        return unit, [(recipient, *content) for recipient, content in zip(recipients, rendered)]
+    except Exception:
+        pass
+    # Find the rows at fault one by one
+    kept, messages = [], []
+    for row, recipient in zip(unit, recipients):
+        try:
+            messages.append((recipient, *compiled.render(merge_context(recipient, row[6]))))
+            kept.append(row)
+        except Exception as e:
+            outcomes[row[0]] = ("failed", f"Template error: {e}", 0, None)
+    return kept, messages
+
+
+def _send_campaign_rows(campaign, rows):
+    """Send claimed rows of one campaign; returns {row_id: (status, detail, sent_count, retry_after)}.
+
+    status is 'sent', 'failed' (permanent error), 'retry' (transient error)
+    or 'deferred' (held back by a daily quota). retry_after is the number of
+    seconds the provider or rate limiter asked us to wait, if any. Recipients
+    that failed for good are logged to sent_emails as not delivered.
+    """
+    user_id, provider, subject, body, reply_to, signature, template_id, template_version, templated = campaign
+    outcomes = {}
+    try:
+        compiled = get_compiled(subject, body, template_id, template_version, templated)
+    except Exception as e:
+        # A template that doesn't compile will never send
+        return {row[0]: ("failed", f"Template error: {e}", 0, None) for row in rows}
+
+    individual, shared = [], []
+    for row in rows:
+        if _is_individual(row[2:5]):
+            individual.append(row)
+        else:
+            shared.append(row)
+
+    undelivered = []  # (recipient, subject) of sends that failed for good
+    size = PROVIDER_UNIT_SIZE[provider]
+    rendered, messages = [], []
+    for start in range(0, len(individual), size):
+        unit, unit_messages = _render_unit(compiled, subject, body, template_id, template_version, templated,
+                                           individual[start:start + size], outcomes)
+        rendered.extend(unit)
+        messages.extend(unit_messages)
+    # The engine sends the units in parallel, within the provider's concurrency limit
+    results = run_campaign(provider, messages, reply_to, signature, user_id=user_id) if messages else {}
+    missing = {"status": "failed", "detail": "No result for recipient"}
+    for row, (recipient, row_subject, _) in zip(rendered, messages):
+        result = results.get(recipient, missing)
+        if result["status"] == "sent":
+            outcomes[row[0]] = ("sent", None, 1, None)
+        elif result["status"] == "deferred":
+            outcomes[row[0]] = ("deferred", None, 0, result["detail"])
+        else:
+            outcomes[row[0]] = _failure(provider, result)
+            if _is_final(outcomes[row[0]], row):
+                undelivered.append((recipient, row_subject))
+
+    for row in shared:
+        row_subject = subject
+        try:
+            # A shared message is personalized for its first To address; free text comes back as written
+            first = (row[2] or "").split(",")[0].strip()
+            row_subject, row_body = compiled.render(merge_context(first, row[6]))
+            results = send_shared(provider, row_subject, row_body, row[2], row[3], row[4], reply_to, signature, user_id)
+        except Exception as e:
+            transient, retry_after = classify_exception(provider, e)
+            outcomes[row[0]] = ("retry" if transient else "failed", str(e), 0, retry_after)
+            if _is_final(outcomes[row[0]], row):
+                recipients = split_recipients(row[2]) + split_recipients(row[3]) + split_recipients(row[4])
+                undelivered.extend((recipient, row_subject) for recipient in recipients)
+            continue
+        if results and all(res["status"] == "deferred" for res in results.values()):
+            outcomes[row[0]] = ("deferred", None, 0, max(res["detail"] for res in results.values()))
+            continue
+        failed = {r: res for r, res in results.items() if res["status"] != "sent"}
+        sent_count = len(results) - len(failed)
+        error = "; ".join(f"{r}: {res['detail']}" for r, res in failed.items()) or None
+        # Partially refused shared messages still went out, so don't resend them
+        if sent_count > 0 or not results:
+            outcomes[row[0]] = ("sent", error, sent_count, None)
+            undelivered.extend((recipient, row_subject) for recipient in failed)
+            continue
+        failures = [_failure(provider, res) for res in failed.values()]
+        transient = any(status == "retry" for status, _, _, _ in failures)
+        retry_after = max((wait for _, _, _, wait in failures if wait), default=None)
+        outcomes[row[0]] = ("retry" if transient else "failed", error, 0, retry_after)
+        if _is_final(outcomes[row[0]], row):
+            undelivered.extend((recipient, row_subject) for recipient in failed)
+
+    record_undelivered(provider, undelivered)
+    return outcomes
+
+
+def process_outbox_batch():
+    """Claim a batch of due messages, send them and record each outcome. Returns the batch size."""
+    now = datetime.now(timezone.utc)
+    with transaction(immediate=True) as conn:
+        cursor = conn.cursor()
+        _requeue_stale(cursor, now)
+        rows = _claim(cursor, now)
+    if not rows:
+        return 0
+
+    with _in_flight_lock:
+        _in_flight.update(row[0] for row in rows)
+    try:
+        _send_batch(rows)
+    finally:
+        # Anything left unresolved (an error above) is picked up again once its lease runs out
+        with _in_flight_lock:
+            _in_flight.difference_update(row[0] for row in rows)
+    return len(rows)
+
+
+def _send_batch(rows):
+    """Send claimed rows campaign by campaign and record each outcome."""
+    attempts = {row[0]: row[5] for row in rows}
+    by_campaign = {}
+    for row in rows:
+        by_campaign.setdefault(row[1], []).append(row)
+
+    for campaign_id, campaign_rows in by_campaign.items():
+        with connection() as conn:
+            campaign = conn.execute("""
+                SELECT user_id, provider, subject, body, reply_to, signature, template_id, template_version, templated
+                FROM outbox_campaigns WHERE id = ?
+            """, (campaign_id,)).fetchone()
+        outcomes = _send_campaign_rows(campaign, campaign_rows)
+
+        now = datetime.now(timezone.utc)
+        with transaction() as conn:
+            for row_id, (status, detail, _, retry_after) in outcomes.items():
+                # owner = ? leaves rows alone if our lease lapsed and another worker took them
+                if status == "sent":
+                    conn.execute("""
+                        UPDATE outbox SET status = 'sent', owner = NULL, lease_expires_at = NULL, last_error = ?, updated_at = ?
+                        WHERE id = ? AND owner = ?
+                    """, (detail, now, row_id, WORKER_ID))
+                elif status == "deferred":
+                    conn.execute("""
+                        UPDATE outbox SET status = 'queued', attempts = attempts - 1, owner = NULL, lease_expires_at = NULL,
+                               last_error = ?, next_attempt_at = ?, updated_at = ?
+                        WHERE id = ? AND owner = ?
+                    """, ("Daily sending limit reached", now + timedelta(seconds=retry_after), now, row_id, WORKER_ID))
+                elif status == "failed" or attempts[row_id] >= OUTBOX_MAX_ATTEMPTS:
+                    conn.execute("""
+                        UPDATE outbox SET status = 'failed', owner = NULL, lease_expires_at = NULL, last_error = ?, updated_at = ?
+                        WHERE id = ? AND owner = ?
+                    """, (detail, now, row_id, WORKER_ID))
+                else:
+                    retry_at = now + timedelta(seconds=backoff_delay(attempts[row_id], retry_after))
+                    conn.execute("""
+                        UPDATE outbox SET status = 'retrying', owner = NULL, lease_expires_at = NULL, last_error = ?,
+                               next_attempt_at = ?, updated_at = ?
+                        WHERE id = ? AND owner = ?
+                    """, (detail, retry_at, now, row_id, WORKER_ID))
+        notify_writes()
+        with _in_flight_lock:
+            _in_flight.difference_update(row[0] for row in campaign_rows)
+        log_email_activity(campaign[0], sum(sent for _, _, sent, _ in outcomes.values()), campaign[1])
+
+
+def _worker_loop():
+    while True:
+        try:
+            if process_outbox_batch():
+                continue
+        except Exception as e:
+            print(f"Outbox worker error: {e}")
+        _wakeup.wait(OUTBOX_POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_outbox_workers(count=OUTBOX_WORKERS):
+    """Start the outbox worker threads once per process."""
+    with _workers_lock:
+        if _workers:
+            return
+        for i in range(count):
+            worker = threading.Thread(target=_worker_loop, name=f"outbox-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+        threading.Thread(target=_renew_leases, name="outbox-leases", daemon=True).start()
@@ -2,10 +2,12 @@ import os
 import msal
 from dotenv import load_dotenv
 import requests
-import sqlite3
+from requests.adapters import HTTPAdapter
+import threading
 import webbrowser
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from datetime import datetime, timezone
+from retry_policy import parse_retry_after
+from delivery_log import delivery_log
 
 # Load environment variables
 load_dotenv()
@@ -17,7 +19,55 @@ TENANT_ID = os.getenv("TENANT_ID")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 REDIRECT_URI = "http://localhost:8000/getAToken"  # Ensure this matches the registered redirect URI
 
-access_token = None  # Initialize access_token
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_BATCH_SIZE = 20  # Graph JSON batching accepts at most 20 requests per $batch call
+GRAPH_MAILBOX_CONCURRENCY = 4  # Graph runs at most 4 requests per mailbox at once; more come back 429
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "10"))
+GRAPH_TIMEOUT = int(os.getenv("GRAPH_TIMEOUT", "30"))  # seconds
+
+AUTHORITY = "https://login.microsoftonline.com/consumers"
+SCOPES = ["https://graph.microsoft.com/.default"]
+TOKEN_CACHE_FILE = os.getenv("OUTLOOK_TOKEN_CACHE", "outlook_token_cache.bin")
+AUTH_TIMEOUT = int(os.getenv("OUTLOOK_AUTH_TIMEOUT", "120"))  # seconds to wait for the browser redirect
+
+# Shared session so Graph calls reuse keep-alive connections
+graph_session = requests.Session()
+graph_session.mount("https://", HTTPAdapter(pool_connections=GRAPH_POOL_SIZE, pool_maxsize=GRAPH_POOL_SIZE))
+
+# Persistent MSAL token cache, so refresh tokens survive restarts
+token_cache = msal.SerializableTokenCache()
+if os.path.exists(TOKEN_CACHE_FILE):
+    with open(TOKEN_CACHE_FILE, "r") as f:
+        token_cache.deserialize(f.read())
+
+_msal_app = None
+_msal_app_lock = threading.Lock()  # the app is built once, on first use
+cache_lock = threading.Lock()  # guards the token cache and its file
+auth_lock = threading.Lock()  # only one interactive authorization at a time
+
+def get_msal_app():
+    """The MSAL application, created on first use.
+
+    Building it discovers the authority over the network, so it isn't done
+    at import time: importing the app works offline and without Outlook.
+    """
+    global _msal_app
+    with _msal_app_lock:
+        if _msal_app is None:
+            _msal_app = msal.ConfidentialClientApplication(
+                CLIENT_ID,
+                authority=AUTHORITY,
+                client_credential=CLIENT_SECRET,
+                token_cache=token_cache,
+                http_client=graph_session,
+            )
+        return _msal_app
+
+def save_token_cache():
+    """Write the MSAL token cache back to disk if it changed."""
+    if token_cache.has_state_changed:
+        with open(TOKEN_CACHE_FILE, "w") as f:
+            f.write(token_cache.serialize())
 
 class OAuthHandler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -27,54 +77,74 @@ class OAuthHandler(BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header("Content-type", "text/html")
             self.end_headers()
-            self.wfile.write(b"Authorization successful. You can close this window.")
-            global access_token
-            access_token = token["access_token"]
+            if "access_token" in token:
+                self.wfile.write(b"Authorization successful. You can close this window.")
+            else:
+                self.wfile.write(b"Authorization failed. Please try again.")
 
 def create_authorization_url():
     """Create the authorization URL for Outlook authentication."""
-    authority = "https://login.microsoftonline.com/consumers"
-    scopes = ["https://graph.microsoft.com/.default"]
-    auth_url = f"{authority}/oauth2/v2.0/authorize?client_id={CLIENT_ID}&response_type=code&redirect_uri={REDIRECT_URI}&response_mode=query&scope={' '.join(scopes)}&state=12345"
-    return auth_url
+    return get_msal_app().get_authorization_request_url(SCOPES, redirect_uri=REDIRECT_URI, state="12345")
 
 def get_token_from_code(code):
-    """Exchange the authorization code for an access token."""
-    authority = "https://login.microsoftonline.com/consumers"
-    token_url = f"{authority}/oauth2/v2.0/token"
-    token_data = {
-        "client_id": CLIENT_ID,
-        "scope": "https://graph.microsoft.com/.default",
-        "code": code,
-        "redirect_uri": REDIRECT_URI,
-        "grant_type": "authorization_code",
-        "client_secret": CLIENT_SECRET,
-    }
-    token_r = requests.post(token_url, data=token_data)
-    token = token_r.json()
+    """Exchange the authorization code for tokens and store them in the cache."""
+    with cache_lock:
+        token = get_msal_app().acquire_token_by_authorization_code(code, scopes=SCOPES, redirect_uri=REDIRECT_URI)
+        save_token_cache()
+    if "error" in token:
+        print(f"Outlook authorization failed: {token.get('error_description', token['error'])}")
     return token
 
-def get_outlook_access_token():
-    """Authenticate and get access token from Microsoft Graph API."""
-    global access_token
-    if access_token:
+def get_cached_access_token():
+    """Return a valid access token from the cache, refreshing it silently; None if authorization is needed."""
+    with cache_lock:
+        app = get_msal_app()
+        accounts = app.get_accounts()
+        if not accounts:
+            return None
+        result = app.acquire_token_silent(SCOPES, account=accounts[0])
+        save_token_cache()
+    if result and "access_token" in result:
+        return result["access_token"]
+    return None
+
+def get_outlook_access_token(interactive=False):
+    """Authenticate and get access token from Microsoft Graph API.
+
+    Tokens come from the MSAL cache and are refreshed silently. If there is
+    no usable token, background callers (interactive=False) get None right
+    away instead of blocking; interactive callers open the browser and wait
+    up to AUTH_TIMEOUT seconds for the redirect.
+    """
+    access_token = get_cached_access_token()
+    if access_token or not interactive:
         return access_token
 
-    auth_url = create_authorization_url()
-    webbrowser.open(auth_url)
+    # Someone else is already waiting on the browser redirect
+    if not auth_lock.acquire(blocking=False):
+        return None
+    try:
+        auth_url = create_authorization_url()
+        webbrowser.open(auth_url)
 
-    server = HTTPServer(("localhost", 8000), OAuthHandler)
-    server.handle_request()
+        server = HTTPServer(("localhost", 8000), OAuthHandler)
+        server.timeout = AUTH_TIMEOUT
+        try:
+            server.handle_request()
+        finally:
+            server.server_close()
+    finally:
+        auth_lock.release()
 
-    return access_token
+    return get_cached_access_token()
 
 def test_access_token():
     """Test the access token by querying Microsoft Graph API."""
     try:
-        access_token = get_outlook_access_token()
-        test_url = "https://graph.microsoft.com/v1.0/users"
+        access_token = get_outlook_access_token(interactive=True)
+        test_url = f"{GRAPH_URL}/users"
         headers = {"Authorization": f"Bearer {access_token}"}
-        response = requests.get(test_url, headers=headers)
+        response = graph_session.get(test_url, headers=headers, timeout=GRAPH_TIMEOUT)
 
         if response.status_code == 200:
             print("Access token test successful. User data retrieved.")
@@ -83,79 +153,134 @@ def test_access_token():
     except Exception as e:
         print(f"Error testing access token: {e}")
 
-def send_email_via_outlook(to, subject, body, cc=None, bcc=None):
-    """Send an email via Outlook using Microsoft Graph API and log the details."""
+def _split_addresses(addresses):
+    return [{"emailAddress": {"address": addr.strip()}} for addr in addresses.split(",") if addr.strip()] if addresses else []
+
+def build_outlook_message(to, subject, body, cc=None, bcc=None):
+    """Build the Graph sendMail payload for one message."""
+    return {
+        "message": {
+            "subject": subject,
+            "body": {
+                "contentType": "HTML",
+                "content": body
+            },
+            "toRecipients": _split_addresses(to),
+            "ccRecipients": _split_addresses(cc),
+            "bccRecipients": _split_addresses(bcc)
+        },
+        "saveToSentItems": "true"
+    }
+
+def send_email_via_outlook(to, subject, body, cc=None, bcc=None, interactive=False):
+    """Send an email via Outlook using Microsoft Graph API and log the details.
+
+    Returns None if the application still needs to be authorized.
+    """
     try:
-        access_token = get_outlook_access_token()
+        access_token = get_outlook_access_token(interactive)
+        if not access_token:
+            return None
 
-        url = f"https://graph.microsoft.com/v1.0/users/{SENDER_EMAIL}/sendMail"
+        url = f"{GRAPH_URL}/users/{SENDER_EMAIL}/sendMail"
         headers = {
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json"
         }
 
-        email_data = {
-            "message": {
-                "subject": subject,
-                "body": {
-                    "contentType": "HTML",
-                    "content": body
-                },
-                "toRecipients": [{"emailAddress": {"address": addr.strip()}} for addr in to.split(",")],
-                "ccRecipients": [{"emailAddress": {"address": addr.strip()}} for addr in cc.split(",")] if cc else [],
-                "bccRecipients": [{"emailAddress": {"address": addr.strip()}} for addr in bcc.split(",")] if bcc else []
-            },
-            "saveToSentItems": "true"
-        }
+        email_data = build_outlook_message(to, subject, body, cc, bcc)
 
-        response = requests.post(url, headers=headers, json=email_data)
+        response = graph_session.post(url, headers=headers, json=email_data, timeout=GRAPH_TIMEOUT)
 
         # Log email details to the database
-        conn = sqlite3.connect('mass_mail.db')
-        cursor = conn.cursor()
-
         if response.status_code == 202:
             # Log success
             message_id = response.headers.get('Message-Id', None)  # Optional
-            cursor.execute("""
-                INSERT INTO sent_emails (sender, recipient, subject, message_id, status, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                SENDER_EMAIL,
-                to,
-                subject,
-                message_id,
-                "inbox",
-                datetime.now(timezone.utc)
-            ))
-            conn.commit()
-            conn.close()
+            delivery_log.record(SENDER_EMAIL, to, subject, message_id, "inbox")
             print("Email sent successfully.")
             return {"status": "success", "message": "Email sent successfully."}
         else:
-            # Log failure
+            # Failures are logged by the caller once they are final (no more retries)
             error_details = response.json()
-            cursor.execute("""
-                INSERT INTO sent_emails (sender, recipient, subject, message_id, status, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                SENDER_EMAIL,
-                to,
-                subject,
-                None,
-                "not delivered",
-                datetime.now(timezone.utc)
-            ))
-            conn.commit()
-            conn.close()
             print(f"Failed to send email: {response.status_code} - {error_details}")
             return {
                 "status": "failure",
                 "error_code": response.status_code,
                 "error_message": error_details,
+                "retry_after": parse_retry_after(response.headers.get("Retry-After")),
             }
     except Exception as e:
         print(f"An error occurred while sending email via Outlook: {e}")
         raise
 
+def send_emails_via_outlook_batch(emails, interactive=False):
+    """Send many (to, subject, body) emails through Graph JSON $batch calls.
+
+    Up to GRAPH_BATCH_SIZE sendMail requests are packed into each $batch
+    call and the per-request statuses are fanned back out into one result
+    dict per email, in the same shape send_email_via_outlook returns.
+    Requests in a batch are chained with dependsOn into
+    GRAPH_MAILBOX_CONCURRENCY lanes, so Graph never runs more than that
+    many against the mailbox at once. If a request fails, the rest of its
+    lane comes back 424 (Failed Dependency) without being sent.
+    Returns None if the application still needs to be authorized.
+    """
+    access_token = get_outlook_access_token(interactive)
+    if not access_token:
+        return None
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    results = []
+    log_rows = []
+
+    for start in range(0, len(emails), GRAPH_BATCH_SIZE):
+        chunk = emails[start:start + GRAPH_BATCH_SIZE]
+        batch_requests = []
+        for i, (to, subject, body) in enumerate(chunk):
+            request = {
+                "id": str(i),
+                "method": "POST",
+                "url": f"/users/{SENDER_EMAIL}/sendMail",
+                "headers": {"Content-Type": "application/json"},
+                "body": build_outlook_message(to, subject, body),
+            }
+            if i >= GRAPH_MAILBOX_CONCURRENCY:
+                request["dependsOn"] = [str(i - GRAPH_MAILBOX_CONCURRENCY)]
+            batch_requests.append(request)
+        batch = {"requests": batch_requests}
+        response = graph_session.post(f"{GRAPH_URL}/$batch", headers=headers, json=batch, timeout=GRAPH_TIMEOUT)
+
+        if response.status_code != 200:
+            # The whole batch was rejected, so every request in it failed
+            error_details = response.json()
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            statuses = {str(i): (response.status_code, error_details, retry_after) for i in range(len(chunk))}
+        else:
+            # Throttled requests inside a batch carry their own Retry-After header
+            statuses = {
+                r["id"]: (r["status"], r.get("body"), parse_retry_after((r.get("headers") or {}).get("Retry-After")))
+                for r in response.json().get("responses", [])
+            }
+
+        for i, (to, subject, body) in enumerate(chunk):
+            status_code, details, retry_after = statuses.get(str(i), (None, "No response for request", None))
+            if status_code == 202:
+                results.append({"status": "success", "message": "Email sent successfully."})
+                log_rows.append((SENDER_EMAIL, to, subject, None, "inbox", None))
+            else:
+                results.append({
+                    "status": "failure",
+                    "error_code": status_code,
+                    "error_message": details,
+                    "retry_after": retry_after,
+                })
+
+    # Log sent emails to the database; failures are logged by the caller once they are final
+    delivery_log.record_many(log_rows)
 
+    sent = sum(1 for result in results if result["status"] == "success")
+    print(f"Outlook batch sent {sent} of {len(emails)} emails.")
+    return results
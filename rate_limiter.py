@@ -0,0 +1,196 @@
+import os
+import time
+import threading
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+from activity import daily_counts
+
+
+load_dotenv()
+
+# Messages per second and per day for each provider
+PROVIDER_LIMITS = {
+    "SMTP": (float(os.getenv("SMTP_RATE_PER_SECOND", "5")), int(os.getenv("SMTP_DAILY_LIMIT", "2000"))),
+    "Gmail API": (float(os.getenv("GMAIL_RATE_PER_SECOND", "2.5")), int(os.getenv("GMAIL_DAILY_LIMIT", "2000"))),
+    "outlook": (float(os.getenv("OUTLOOK_RATE_PER_SECOND", "0.5")), int(os.getenv("OUTLOOK_DAILY_LIMIT", "10000"))),
+}
+USER_RATE_PER_SECOND = float(os.getenv("USER_RATE_PER_SECOND", "5"))
+USER_DAILY_LIMIT = int(os.getenv("USER_DAILY_LIMIT", "100"))
+RATE_LIMIT_RESYNC = int(os.getenv("RATE_LIMIT_RESYNC", "60"))  # seconds between re-reads of the persisted daily counts
+
+# Adaptive rate: halve a provider's rate when it throttles us, creep back up on success
+RATE_DECREASE_FACTOR = 0.5
+RATE_RECOVERY_STEP = float(os.getenv("RATE_RECOVERY_STEP", "0.05"))  # fraction of the configured rate regained per successful unit
+RATE_MIN_FACTOR = float(os.getenv("RATE_MIN_FACTOR", "0.05"))
+THROTTLE_COOLDOWN = 5  # seconds; throttles reported by concurrent units in this window count once
+MAX_THROTTLE_PAUSE = int(os.getenv("MAX_THROTTLE_PAUSE", "60"))  # longest Retry-After that pauses the whole provider
+
+
+class TokenBucket:
+    """Messages-per-second bucket. acquire() reserves tokens and returns how long to wait for them."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going negative reserves future tokens, so concurrent callers queue up in order
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+
+    def pause(self, seconds):
+        """Hold back every caller for at least the given number of seconds."""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def seconds_until_tomorrow():
+    now = datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+
+class RateLimiter:
+    """Per-provider and per-user rate limits for messages per second and per day.
+
+    Daily usage is seeded from email_activity / provider_activity (what was
+    actually sent, across restarts and processes) and tracked in memory
+    between re-reads, so reservations made by in-flight sends count too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._used = {}  # (kind, key) -> [date, count, synced_at]
+        self._factors = {provider: 1.0 for provider in PROVIDER_LIMITS}  # current share of the configured rate
+        self._last_throttle = {}
+
+    def _bucket(self, kind, key, rate):
+        with self._lock:
+            bucket = self._buckets.get((kind, key))
+            if bucket is None:
+                bucket = self._buckets[(kind, key)] = TokenBucket(rate)
+            return bucket
+
+    def _persisted(self, kind, key):
+        """(date, count) read from the database if the entry is due a re-read, else None.
+
+        Called without the lock held, so a slow read doesn't stall every
+        other provider and user; _usage merges the result under the lock.
+        """
+        today = date.today()
+        with self._lock:
+            entry = self._used.get((kind, key))
+            if entry is not None and entry[0] == today and time.monotonic() - entry[2] <= RATE_LIMIT_RESYNC:
+                return None
+        if kind == "user":
+            return today, daily_counts(user_id=key)[0]
+        return today, daily_counts(provider=key)[1]
+
+    def _usage(self, kind, key, persisted=None):
+        """Today's usage entry for a provider or user, merged with a count from _persisted. Call with the lock held."""
+        today = date.today()
+        entry = self._used.get((kind, key))
+        if entry is None or entry[0] != today:
+            entry = self._used[(kind, key)] = [today, 0, 0.0]
+        if persisted is not None and persisted[0] == today:
+            entry[1] = max(entry[1], persisted[1])
+            entry[2] = time.monotonic()
+        return entry
+
+    def daily_limit(self, provider, user_id=None):
+        limit = PROVIDER_LIMITS[provider][1]
+        return min(limit, USER_DAILY_LIMIT) if user_id else limit
+
+    def remaining_today(self, provider, user_id=None):
+        provider_count = self._persisted("provider", provider)
+        user_count = self._persisted("user", user_id) if user_id else None
+        with self._lock:
+            remaining = PROVIDER_LIMITS[provider][1] - self._usage("provider", provider, provider_count)[1]
+            if user_id:
+                remaining = min(remaining, USER_DAILY_LIMIT - self._usage("user", user_id, user_count)[1])
+            return max(0, remaining)
+
+    def acquire(self, provider, user_id, n, partial=True):
+        """Reserve budget for n messages, blocking for the per-second limits.
+
+        Returns (granted, retry_after). granted may be less than n when the
+        daily budget runs low (or 0 when partial=False and all n don't fit);
+        the rest should be queued and retried after retry_after seconds,
+        when the daily budget refills.
+        """
+        rate = PROVIDER_LIMITS[provider][0] * self._factors[provider]
+        provider_count = self._persisted("provider", provider)
+        user_count = self._persisted("user", user_id) if user_id else None
+        with self._lock:
+            provider_usage = self._usage("provider", provider, provider_count)
+            user_usage = self._usage("user", user_id, user_count) if user_id else None
+            remaining = PROVIDER_LIMITS[provider][1] - provider_usage[1]
+            if user_usage is not None:
+                remaining = min(remaining, USER_DAILY_LIMIT - user_usage[1])
+            granted = max(0, min(n, remaining))
+            if granted < n and not partial:
+                granted = 0
+            provider_usage[1] += granted
+            if user_usage is not None:
+                user_usage[1] += granted
+        retry_after = seconds_until_tomorrow() if granted < n else 0
+        if not granted:
+            return 0, retry_after
+
+        wait = self._bucket("provider", provider, rate).acquire(granted)
+        if user_id:
+            wait = max(wait, self._bucket("user", user_id, USER_RATE_PER_SECOND).acquire(granted))
+        if wait:
+            time.sleep(wait)
+        return granted, retry_after
+
+    def refund(self, provider, user_id, n):
+        """Give back daily budget reserved for messages that were not sent."""
+        if n <= 0:
+            return
+        with self._lock:
+            self._usage("provider", provider)[1] -= n
+            if user_id:
+                self._usage("user", user_id)[1] -= n
+
+
+    def throttled(self, provider, retry_after=None):
+        """The provider pushed back (429, 421, ...): slow down and honor its Retry-After."""
+        bucket = self._bucket("provider", provider, PROVIDER_LIMITS[provider][0] * self._factors[provider])
+        if retry_after:
+            bucket.pause(min(retry_after, MAX_THROTTLE_PAUSE))
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_throttle.get(provider, 0) < THROTTLE_COOLDOWN:
+                return
+            self._last_throttle[provider] = now
+            self._factors[provider] = max(RATE_MIN_FACTOR, self._factors[provider] * RATE_DECREASE_FACTOR)
+            factor = self._factors[provider]
+        bucket.set_rate(PROVIDER_LIMITS[provider][0] * factor)
+        print(f"{provider} is throttling sends; rate lowered to {PROVIDER_LIMITS[provider][0] * factor:.2f}/s")
+
+    def recovered(self, provider):
+        """A unit went through without throttling: step the rate back towards the configured one."""
+        with self._lock:
+            if self._factors[provider] >= 1.0:
+                return
+            self._factors[provider] = min(1.0, self._factors[provider] + RATE_RECOVERY_STEP)
+            factor = self._factors[provider]
+        self._bucket("provider", provider, PROVIDER_LIMITS[provider][0] * factor).set_rate(PROVIDER_LIMITS[provider][0] * factor)
+
+
+rate_limiter = RateLimiter()
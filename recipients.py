@@ -0,0 +1,197 @@
+import os
+import json
+import pandas as pd
+from dotenv import load_dotenv
+from db import connection, transaction
+
+
+load_dotenv()
+
+CSV_CHUNK_SIZE = int(os.getenv("CSV_CHUNK_SIZE", "50000"))  # CSV rows parsed and inserted at a time
+RECIPIENT_FETCH_SIZE = 1000  # rows read per query when streaming a list back out
+SUPPRESSION_LOOKUP_SIZE = 500  # addresses per IN (...) lookup against a large suppression table
+EMAIL_COLUMN = "Email"
+# Deliberately loose: one @, no spaces, a dot in the domain
+EMAIL_PATTERN = r"[^@\s,;<>]+@[^@\s,;<>]+\.[^@\s,;<>]+"
+
+
+def normalize_emails(emails):
+    """Strip whitespace and lowercase the domain part of a Series of addresses."""
+    emails = emails.astype("string").str.strip()
+    if emails.empty:
+        return emails
+    parts = emails.str.rpartition("@")
+    return parts[0] + parts[1] + parts[2].str.lower()
+
+
+def valid_emails(emails):
+    """Boolean Series: True where the address is syntactically plausible."""
+    return emails.str.fullmatch(EMAIL_PATTERN).fillna(False).astype(bool)
+
+
+def add_suppressions(emails, reason):
+    """Record addresses (bounced, unsubscribed, ...) that must no longer be sent to.
+
+    Called by the SMTP senders for hard bounces and by the dashboard's
+    unsubscribe form.
+    """
+    with transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO suppressions (email, reason) VALUES (?, ?)",
+                         ((email.strip().lower(), reason) for email in emails if email and email.strip()))
+
+
+def suppressed_mask(keys, conn):
+    """Boolean Series: True where the lowercased address is in the suppression table.
+
+    Small suppression tables are loaded whole and matched with isin; when the
+    table is larger than the batch, only the batch is looked up through the
+    primary key index.
+    """
+    unique_keys = keys.dropna().unique()
+    total = conn.execute("SELECT COUNT(*) FROM suppressions").fetchone()[0]
+    if not total or not len(unique_keys):
+        return pd.Series(False, index=keys.index)
+    if total <= len(unique_keys):
+        found = pd.read_sql_query("SELECT email FROM suppressions", conn)["email"]
+    else:
+        found = []
+        for start in range(0, len(unique_keys), SUPPRESSION_LOOKUP_SIZE):
+            chunk = [str(key) for key in unique_keys[start:start + SUPPRESSION_LOOKUP_SIZE]]
+            placeholders = ", ".join("?" for _ in chunk)
+            found.extend(row[0] for row in conn.execute(
+                f"SELECT email FROM suppressions WHERE email IN ({placeholders})", chunk))
+    return keys.isin(found).fillna(False).astype(bool)
+
+
+def clean_addresses(emails, conn=None):
+    """Normalize, validate, dedupe and suppression-filter a Series of addresses.
+
+    Everything runs as pandas string/array operations, so a million
+    addresses take seconds. Duplicates are matched case-insensitively and
+    the first occurrence is kept. Returns (boolean keep mask, normalized
+    addresses, stats dict of input/invalid/duplicates/suppressed/kept).
+    """
+    if conn is None:
+        with connection() as conn:
+            return clean_addresses(emails, conn)
+    normalized = normalize_emails(emails)
+    keys = normalized.str.lower()
+    valid = valid_emails(normalized)
+    duplicate = valid & keys.where(valid).duplicated()
+    suppressed = valid & ~duplicate & suppressed_mask(keys.where(valid & ~duplicate), conn)
+    keep = valid & ~duplicate & ~suppressed
+    stats = {
+        "input": len(emails),
+        "invalid": int((~valid).sum()),
+        "duplicates": int(duplicate.sum()),
+        "suppressed": int(suppressed.sum()),
+        "kept": int(keep.sum()),
+    }
+    return keep, normalized, stats
+
+
+def clean_recipients(to, cc, bcc):
+    """Clean comma separated To/CC/BCC strings together.
+
+    An address is kept in the first field it appears in (To, then CC, then
+    BCC). Returns (to, cc, bcc) as comma separated strings plus the stats
+    from clean_addresses.
+    """
+    fields = ("to", "cc", "bcc")
+    parts = [(field, address) for field, value in zip(fields, (to, cc, bcc)) for address in (value or "").split(",")]
+    frame = pd.DataFrame(parts, columns=["field", "email"])
+    frame = frame[frame["email"].str.strip() != ""]
+    keep, normalized, stats = clean_addresses(frame["email"])
+    kept = pd.DataFrame({"field": frame["field"][keep], "email": normalized[keep]})
+    cleaned = tuple(", ".join(kept["email"][kept["field"] == field]) for field in fields)
+    return (*cleaned, stats)
+
+
+def ingest_csv(csv_file, user_id, name=None):
+    """Stream a CSV of recipients into a new recipient list.
+
+    The file is parsed CSV_CHUNK_SIZE rows at a time; each chunk is
+    normalized, validated and bulk inserted (and committed) before the next
+    one is read, so memory stays flat however long the list is and other
+    writers aren't locked out for the whole upload. Columns other than
+    Email are kept per recipient as JSON. Invalid, duplicate and suppressed
+    addresses are dropped (see clean_addresses). Returns (list_id, stats dict).
+    Raises ValueError if the CSV has no Email column.
+    """
+    stats = {"rows": 0, "valid": 0, "invalid": 0, "duplicates": 0, "suppressed": 0}
+    extra = []
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO recipient_lists (user_id, name) VALUES (?, ?)", (user_id, name))
+        list_id = cursor.lastrowid
+        try:
+            for chunk in pd.read_csv(csv_file, chunksize=CSV_CHUNK_SIZE, dtype=str, keep_default_na=False):
+                if EMAIL_COLUMN not in chunk.columns:
+                    raise ValueError(f"CSV must contain a column named '{EMAIL_COLUMN}'")
+                keep, normalized, chunk_stats = clean_addresses(chunk[EMAIL_COLUMN], conn)
+                rows = chunk.loc[keep].drop(columns=[EMAIL_COLUMN])
+                rows.insert(0, EMAIL_COLUMN, normalized[keep])
+                extra = list(rows.columns[1:])
+                # One transaction per chunk: the write lock is released between chunks so the
+                # outbox, scheduler and delivery log writers get their turn during a long upload.
+                # Duplicates of addresses from earlier chunks are dropped by the unique index
+                with transaction():
+                    cursor.executemany(
+                        "INSERT OR IGNORE INTO recipients (list_id, email, fields) VALUES (?, ?, ?)",
+                        (
+                            (list_id, row[0], json.dumps(dict(zip(extra, row[1:]))) if extra else None)
+                            for row in rows.itertuples(index=False, name=None)
+                        ),
+                    )
+                    inserted = cursor.rowcount
+                stats["rows"] += len(chunk)
+                stats["valid"] += inserted
+                stats["invalid"] += chunk_stats["invalid"]
+                stats["duplicates"] += chunk_stats["duplicates"] + len(rows) - inserted
+                stats["suppressed"] += chunk_stats["suppressed"]
+            cursor.execute("""
+                UPDATE recipient_lists SET total_rows = ?, valid_count = ?, invalid_count = ?, columns = ? WHERE id = ?
+            """, (stats["rows"], stats["valid"], stats["invalid"], json.dumps(extra), list_id))
+        except BaseException:
+            # Don't leave a half-ingested list behind
+            with transaction():
+                cursor.execute("DELETE FROM recipients WHERE list_id = ?", (list_id,))
+                cursor.execute("DELETE FROM recipient_lists WHERE id = ?", (list_id,))
+            raise
+    return list_id, stats
+
+
+def iter_list_recipients(list_id):
+    """Yield (email, fields JSON) for a recipient list in insertion order, a page at a time.
+
+    Addresses suppressed since the list was uploaded are skipped.
+    """
+    last_id = 0
+    while True:
+        # A connection per page, so a slow consumer doesn't hold one between pages
+        with connection() as conn:
+            rows = conn.execute("""
+                SELECT id, email, fields FROM recipients r
+                WHERE list_id = ? AND id > ?
+                  AND NOT EXISTS (SELECT 1 FROM suppressions s WHERE s.email = lower(r.email))
+                ORDER BY id LIMIT ?
+            """, (list_id, last_id, RECIPIENT_FETCH_SIZE)).fetchall()
+        if not rows:
+            return
+        for _, email, fields in rows:
+            yield email, fields
+        last_id = rows[-1][0]
+
+
+def list_columns(list_id):
+    """The list's extra CSV columns, available to templates as variables."""
+    with connection() as conn:
+        row = conn.execute("SELECT columns FROM recipient_lists WHERE id = ?", (list_id,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else []
+
+
+def list_size(list_id):
+    with connection() as conn:
+        row = conn.execute("SELECT valid_count FROM recipient_lists WHERE id = ?", (list_id,)).fetchone()
+    return row[0] if row else 0
@@ -0,0 +1,126 @@
+import os
+import re
+import random
+import smtplib
+import socket
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))  # sends per message before giving up on transient errors
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "30"))  # seconds, doubled per attempt
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "3600"))  # seconds
+
+# HTTP statuses (Gmail API, Graph) and SMTP reply codes worth retrying
+# 424: a Graph $batch request that wasn't sent because one it depends on failed
+TRANSIENT_HTTP_STATUSES = (408, 424, 429, 500, 502, 503, 504)
+THROTTLE_HTTP_STATUSES = (429, 503)
+THROTTLE_SMTP_CODES = (421, 450, 451, 452)
+# Gmail reports per-user rate limits as 403 with one of these reasons
+THROTTLE_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded")
+# SMTP rejections of the address itself (enhanced status 5.1.x bad mailbox/domain, 5.2.1 disabled),
+# as opposed to policy or content blocks, which also come back as 550
+HARD_BOUNCE_SMTP_CODES = (550, 551, 553)
+HARD_BOUNCE_STATUS = re.compile(r"\b5\.(?:1\.\d{1,3}|2\.1)\b")
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header value (delta-seconds or HTTP date), or None."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def is_throttle(provider, code, detail=""):
+    """True if a failure means the provider wants us to slow down."""
+    if provider == "SMTP":
+        return code in THROTTLE_SMTP_CODES
+    if code in THROTTLE_HTTP_STATUSES:
+        return True
+    return code == 403 and any(reason in str(detail) for reason in THROTTLE_REASONS)
+
+
+def is_transient(provider, code, detail=""):
+    """True if a failure with this SMTP reply code / HTTP status may succeed when retried."""
+    if code is None:
+        return False
+    if provider == "SMTP":
+        # 4yz replies are temporary, 5yz permanent
+        return 400 <= code < 500
+    return code in TRANSIENT_HTTP_STATUSES or is_throttle(provider, code, detail)
+
+
+def is_hard_bounce(code, response=""):
+    """True if an SMTP RCPT rejection says the mailbox doesn't exist or is disabled."""
+    if isinstance(response, bytes):
+        response = response.decode("utf-8", "replace")
+    return code in HARD_BOUNCE_SMTP_CODES and bool(HARD_BOUNCE_STATUS.search(response or ""))
+
+
+def classify_result(provider, result):
+    """(transient, retry_after) for a failed send result dict.
+
+    Senders can decide with an explicit "transient" key; failures without a
+    code (no response, authorization lapsed) are retried up to the cap.
+    """
+    if "transient" in result:
+        transient = result["transient"]
+    elif result.get("code") is None:
+        transient = True
+    else:
+        transient = is_transient(provider, result["code"], result.get("detail"))
+    return transient, result.get("retry_after")
+
+
+def classify_exception(provider, e):
+    """(transient, retry_after) for an exception raised while sending."""
+    if isinstance(e, smtplib.SMTPResponseException):
+        return is_transient("SMTP", e.smtp_code), None
+    if isinstance(e, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError, TimeoutError)):
+        return True, None
+    if isinstance(e, smtplib.SMTPException):
+        # Refused recipients, a missing extension and the like: a retry gets the same answer.
+        # Checked before OSError, which SMTPException subclasses
+        return False, None
+    resp = getattr(e, "resp", None)  # googleapiclient HttpError
+    status = getattr(resp, "status", None)
+    if status is not None:
+        return is_transient(provider, status, e), parse_retry_after(resp.get("retry-after"))
+    # Other network failures (requests exceptions are OSErrors too)
+    return isinstance(e, OSError), None
+
+
+def is_throttle_exception(provider, e):
+    """True if an exception raised while sending was the provider throttling us."""
+    if isinstance(e, smtplib.SMTPResponseException):
+        return is_throttle("SMTP", e.smtp_code)
+    status = getattr(getattr(e, "resp", None), "status", None)
+    return status is not None and is_throttle(provider, status, e)
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number `attempt` (1-based).
+
+    Full-jitter exponential backoff, so retries from many messages spread
+    out instead of hitting the provider together; a Retry-After from the
+    provider is treated as a minimum.
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
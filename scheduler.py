@@ -0,0 +1,372 @@
+import os
+import uuid
+import heapq
+import atexit
+import socket
+import sqlite3
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from db import connection, transaction
+from send_engine import send_shared, split_recipients, record_undelivered
+from gmail_api import gmail_client
+from outlook_api import get_cached_access_token
+from activity import log_email_activity
+from outbox import enqueue_campaign, individual_messages
+from recipients import iter_list_recipients, list_size
+from mail_merge import get_compiled, merge_context, parallel_rendering
+from retry_policy import RETRY_MAX_ATTEMPTS, classify_result, classify_exception, backoff_delay
+
+
+load_dotenv()
+
+# Used for rows scheduled before scheduled_emails had a send_method column
+DEFAULT_SEND_METHOD = os.getenv("SCHEDULED_SEND_METHOD", "Gmail API")
+SCHEDULER_LOAD_LIMIT = int(os.getenv("SCHEDULER_LOAD_LIMIT", "1000"))  # pending rows held in the heap
+SCHEDULER_RESYNC_INTERVAL = int(os.getenv("SCHEDULER_RESYNC_INTERVAL", "300"))  # seconds; catches rows from other processes
+AUTH_RETRY_DELAY = int(os.getenv("SCHEDULER_AUTH_RETRY_DELAY", "60"))  # seconds to wait for a provider to be authorized
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "4"))  # scheduled emails sent in parallel per process
+SCHEDULER_CLAIM_BATCH = int(os.getenv("SCHEDULER_CLAIM_BATCH", "20"))  # rows claimed per lease round trip
+LEASE_DURATION = int(os.getenv("SCHEDULER_LEASE_DURATION", "300"))  # seconds a claim stays valid without renewal
+LEASE_RENEW_INTERVAL = LEASE_DURATION / 3
+PROVIDERS = ("Gmail API", "SMTP", "outlook")
+
+# Identifies this scheduler process in scheduled_emails.owner
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _due_at(schedule_time):
+    """Parse a stored schedule_time into a naive local datetime."""
+    if isinstance(schedule_time, str):
+        schedule_time = datetime.fromisoformat(schedule_time)
+    if schedule_time.tzinfo is not None:
+        schedule_time = schedule_time.astimezone().replace(tzinfo=None)
+    return schedule_time
+
+
+def _provider_ready(send_method):
+    """False if the provider still needs interactive authorization or can't be checked right now.
+
+    A check that raises (a revoked Gmail token, the MSAL authority lookup
+    failing during a network blip) only holds back that provider's rows.
+    """
+    try:
+        if send_method == "Gmail API":
+            return gmail_client.service() is not None
+        if send_method == "outlook":
+            return get_cached_access_token() is not None
+        return True
+    except Exception as e:
+        print(f"Scheduler: {send_method} is not ready: {e}")
+        return False
+
+
+def _lease_expiry():
+    return datetime.now(timezone.utc) + timedelta(seconds=LEASE_DURATION)
+
+
+def _due_rows(providers):
+    """WHERE clause and parameters for rows of these providers that are due or whose lease expired."""
+    now_utc = datetime.now(timezone.utc)
+    placeholders = ", ".join("?" for _ in providers)
+    where = f"""((status = 'Pending' AND schedule_time <= ?
+                  AND (next_attempt_at IS NULL OR next_attempt_at <= ?))
+                 OR (status = 'Sending' AND lease_expires_at < ?))
+                AND COALESCE(send_method, ?) IN ({placeholders})"""
+    return where, (datetime.now(), now_utc, now_utc, DEFAULT_SEND_METHOD, *providers)
+
+
+def _has_due_rows(providers):
+    """True if any of these providers has a row waiting to be sent."""
+    where, params = _due_rows(providers)
+    with connection() as conn:
+        return conn.execute(f"SELECT 1 FROM scheduled_emails WHERE {where} LIMIT 1", params).fetchone() is not None
+
+
+class EmailScheduler:
+    """Sends scheduled_emails rows when they fall due.
+
+    Due times sit in an in-memory min-heap loaded with the indexed
+    (status, schedule_time) query; the thread sleeps until the earliest one
+    and is woken by notify() when the dashboard schedules something new.
+
+    Rows are claimed in batches with an atomic UPDATE that sets owner and
+    lease_expires_at, so several processes can drain the same table without
+    sending anything twice. Leases are renewed while rows are being sent; a
+    row whose lease ran out (its owner crashed) can be claimed again.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._queued = set()
+        self._condition = threading.Condition()
+        self._last_load = None
+        self._more_pending = False  # last load hit SCHEDULER_LOAD_LIMIT
+        self._waiting = set()  # claimed by us but not yet being sent
+        self._sending = set()  # being sent by one of our workers right now
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="email-scheduler", daemon=True)
+            self._thread.start()
+            threading.Thread(target=self._renew_leases, name="email-scheduler-leases", daemon=True).start()
+            atexit.register(self.release)
+
+    def notify(self, email_id, schedule_time):
+        """Tell the scheduler about a newly inserted row."""
+        with self._condition:
+            self._push(email_id, _due_at(schedule_time))
+            self._condition.notify()
+
+    def _push(self, email_id, due_at):
+        if email_id not in self._queued:
+            self._queued.add(email_id)
+            heapq.heappush(self._heap, (due_at, email_id))
+
+    def _load(self):
+        with connection() as conn:
+            rows = conn.execute("""
+                SELECT id, schedule_time, next_attempt_at FROM scheduled_emails
+                WHERE status = 'Pending'
+                ORDER BY schedule_time
+                LIMIT ?
+            """, (SCHEDULER_LOAD_LIMIT,)).fetchall()
+        with self._condition:
+            for email_id, schedule_time, next_attempt_at in rows:
+                due_at = _due_at(schedule_time)
+                if next_attempt_at:
+                    due_at = max(due_at, _due_at(next_attempt_at))
+                self._push(email_id, due_at)
+            self._last_load = datetime.now()
+            self._more_pending = len(rows) >= SCHEDULER_LOAD_LIMIT
+
+    def _wait_until_due(self):
+        """Block until something is due (True) or it is time to reload from the table (False)."""
+        with self._condition:
+            while True:
+                now = datetime.now()
+                resync_at = self._last_load + timedelta(seconds=SCHEDULER_RESYNC_INTERVAL)
+                if now >= resync_at or (not self._heap and self._more_pending):
+                    return False
+                if self._heap and self._heap[0][0] <= now:
+                    # The claim query picks up every due row, so drop all due heap entries
+                    while self._heap and self._heap[0][0] <= now:
+                        _, email_id = heapq.heappop(self._heap)
+                        self._queued.discard(email_id)
+                    return True
+                wake_at = min(self._heap[0][0], resync_at) if self._heap else resync_at
+                self._condition.wait((wake_at - now).total_seconds())
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS, thread_name_prefix="email-scheduler-worker") as executor:
+            while True:
+                try:
+                    if self._last_load is None:
+                        self._load()
+                    if not self._wait_until_due():
+                        self._load()
+                    self._drain(executor)
+                except Exception as e:
+                    print(f"Scheduler error: {e}")
+                    threading.Event().wait(1)
+
+    def _claim(self, ready):
+        """Atomically lease a batch of due rows (or rows whose lease expired) to this process."""
+        where, params = _due_rows(ready)
+        with connection() as conn:
+            rows = conn.execute(f"""
+                UPDATE scheduled_emails SET status = 'Sending', owner = ?, lease_expires_at = ?
+                WHERE id IN (
+                    SELECT id FROM scheduled_emails
+                    WHERE {where}
+                    ORDER BY schedule_time
+                    LIMIT ?
+                )
+                RETURNING id, user_id, to_email, cc_email, bcc_email, subject, body, signature, send_method, attempts,
+                          recipient_list_id, templated, campaign_id
+            """, (WORKER_ID, _lease_expiry(), *params, SCHEDULER_CLAIM_BATCH)).fetchall()
+        with self._condition:
+            self._waiting.update(row[0] for row in rows)
+        return rows
+
+    def _drain(self, executor):
+        """Claim and send due rows batch by batch until none are left."""
+        ready = [p for p in PROVIDERS if _provider_ready(p)]
+        unready = [p for p in PROVIDERS if p not in ready]
+        if unready and _has_due_rows(unready):
+            # Leave rows for unauthorized providers Pending and look again later
+            with self._condition:
+                heapq.heappush(self._heap, (datetime.now() + timedelta(seconds=AUTH_RETRY_DELAY), 0))  # 0: wake-up only
+        if not ready:
+            return
+        while True:
+            rows = self._claim(ready)
+            if not rows:
+                return
+            list(executor.map(self._dispatch, rows))
+
+    def _dispatch(self, row):
+        (email_id, user_id, to_email, cc_email, bcc_email, subject, body, signature, send_method, attempts,
+         recipient_list_id, templated, campaign_id) = row
+        send_method = send_method or DEFAULT_SEND_METHOD
+        attempts = attempts or 0
+        with self._condition:
+            self._waiting.discard(email_id)
+            self._sending.add(email_id)
+        try:
+            if recipient_list_id:
+                extra = split_recipients(to_email) + split_recipients(cc_email) + split_recipients(bcc_email)
+                self._queue_list(email_id, user_id, recipient_list_id, extra, subject, body, signature, send_method,
+                                 campaign_id)
+            else:
+                self._send(email_id, user_id, to_email, cc_email, bcc_email, subject, body, signature, send_method,
+                           attempts, templated)
+        finally:
+            # No longer renewed: if the row wasn't resolved, its lease runs out and it is claimed again
+            with self._condition:
+                self._sending.discard(email_id)
+
+    def _send(self, email_id, user_id, to_email, cc_email, bcc_email, subject, body, signature, send_method, attempts,
+              templated):
+        next_attempt_at = None
+        status = 'Failed'
+        sent = 0
+        results = None
+        try:
+            compiled = get_compiled(subject, body, templated=templated)
+            # Typed recipients have no merge fields beyond their address; free text comes back as written
+            subject, body = compiled.render(merge_context((split_recipients(to_email) or [""])[0], None))
+            results = send_shared(send_method, subject, body, to_email, cc_email, bcc_email, None, signature or "", user_id)
+            deferred = [result["detail"] for result in results.values() if result["status"] == "deferred"]
+            sent = sum(1 for result in results.values() if result["status"] == "sent")
+            if deferred:
+                # Daily quota used up: try again when the limiter expects room
+                next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=max(deferred))
+                status = 'Pending'
+                print(f"Scheduled email {email_id} deferred by rate limit until {next_attempt_at}")
+            elif sent:
+                # Mark as sent
+                status = 'Sent'
+            else:
+                errors = "; ".join(f"{r}: {result['detail']}" for r, result in results.items())
+                print(f"Error sending scheduled email {email_id}: {errors or 'No valid recipients'}")
+                retries = [classify_result(send_method, result) for result in results.values()]
+                if any(transient for transient, _ in retries):
+                    next_attempt_at = self._retry_at(attempts, max((wait or 0) for _, wait in retries))
+        except Exception as e:
+            print(f"Error sending scheduled email {email_id}: {e}")
+            transient, retry_after = classify_exception(send_method, e)
+            if transient:
+                next_attempt_at = self._retry_at(attempts, retry_after)
+
+        if next_attempt_at and status == 'Failed':
+            if attempts + 1 < RETRY_MAX_ATTEMPTS:
+                # Transient error: back off and try again
+                status = 'Pending'
+                attempts += 1
+            else:
+                next_attempt_at = None
+        if status in ('Sent', 'Failed'):
+            # Final outcome: log the recipients that didn't get it (a Pending row will be retried)
+            if results is None:
+                failed = split_recipients(to_email) + split_recipients(cc_email) + split_recipients(bcc_email)
+            else:
+                failed = [recipient for recipient, result in results.items() if result["status"] != "sent"]
+            record_undelivered(send_method, ((recipient, subject) for recipient in failed))
+
+        with connection() as conn:
+            conn.execute("""
+                UPDATE scheduled_emails
+                SET status = ?, owner = NULL, lease_expires_at = NULL, next_attempt_at = ?, attempts = ?
+                WHERE id = ? AND owner = ?
+            """, (status, next_attempt_at, attempts, email_id, WORKER_ID))
+        if next_attempt_at:
+            with self._condition:
+                self._push(email_id, _due_at(next_attempt_at))
+                self._condition.notify()
+        if status == 'Sent':
+            try:
+                log_email_activity(user_id, sent, send_method)
+            except sqlite3.Error as e:
+                # The email went out; a counting error must not change its status
+                print(f"Error logging activity for scheduled email {email_id}: {e}")
+
+    def _queue_list(self, email_id, user_id, list_id, extra, subject, body, signature, send_method, campaign_id=None):
+        """Hand a scheduled send to an uploaded list over to the outbox, one copy per recipient.
+
+        The campaign id is stored on the row in the transaction that creates
+        the campaign. If this process dies partway through, the row's lease
+        runs out and whoever claims it next resumes that campaign, so the
+        chunks already queued aren't queued (and sent) twice.
+        """
+        def record_campaign(conn, new_campaign_id):
+            conn.execute("UPDATE scheduled_emails SET campaign_id = ? WHERE id = ? AND owner = ?",
+                         (new_campaign_id, email_id, WORKER_ID))
+
+        try:
+            messages = individual_messages(chain(iter_list_recipients(list_id), extra))
+            enqueue_campaign(user_id, send_method, subject, body, messages, None, signature or "", templated=True,
+                             prerender=parallel_rendering(list_size(list_id) + len(extra)),
+                             campaign_id=campaign_id, on_created=record_campaign)
+            status = 'Sent'
+        except Exception as e:
+            # Rows queued before the error still go out; the rest of the list is not retried
+            status = 'Failed'
+            print(f"Error queueing scheduled email {email_id}: {e}")
+        with connection() as conn:
+            conn.execute("""
+                UPDATE scheduled_emails SET status = ?, owner = NULL, lease_expires_at = NULL
+                WHERE id = ? AND owner = ?
+            """, (status, email_id, WORKER_ID))
+
+    @staticmethod
+    def _retry_at(attempts, retry_after):
+        return datetime.now(timezone.utc) + timedelta(seconds=backoff_delay(attempts + 1, retry_after))
+
+    def _renew_leases(self):
+        """Renew the leases of rows we claimed and are still holding or sending, and no others."""
+        while True:
+            threading.Event().wait(LEASE_RENEW_INTERVAL)
+            with self._condition:
+                ids = list(self._waiting | self._sending)
+            if not ids:
+                continue
+            try:
+                expiry = _lease_expiry()
+                with transaction() as conn:
+                    conn.executemany("""
+                        UPDATE scheduled_emails SET lease_expires_at = ?
+                        WHERE id = ? AND owner = ? AND status = 'Sending'
+                    """, [(expiry, email_id, WORKER_ID) for email_id in ids])
+            except sqlite3.Error as e:
+                print(f"Error renewing scheduler leases: {e}")
+
+    def release(self):
+        """Hand rows we claimed but haven't started sending back to other schedulers."""
+        with self._condition:
+            waiting = list(self._waiting)
+            self._waiting.clear()
+        if not waiting:
+            return
+        with transaction() as conn:
+            conn.executemany("""
+                UPDATE scheduled_emails SET status = 'Pending', owner = NULL, lease_expires_at = NULL
+                WHERE id = ? AND owner = ? AND status = 'Sending'
+            """, [(email_id, WORKER_ID) for email_id in waiting])
+
+
+email_scheduler = EmailScheduler()
+
+
+def start_scheduler():
+    """Start the scheduler thread once per process."""
+    email_scheduler.start()
+
+
+def notify_scheduled(email_id, schedule_time):
+    email_scheduler.notify(email_id, schedule_time)
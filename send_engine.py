@@ -0,0 +1,338 @@
+import os
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from smtp_pool import get_smtp_pool, chunk_recipients, ACCEPTED_CODES
+from mime_builder import shared_message
+from gmail_api import gmail_client, deliver_gmail_messages, GMAIL_BATCH_SIZE
+from outlook_api import send_email_via_outlook, send_emails_via_outlook_batch, GRAPH_BATCH_SIZE, SENDER_EMAIL
+from rate_limiter import rate_limiter
+from retry_policy import is_throttle, is_throttle_exception, is_hard_bounce, classify_exception
+from delivery_log import delivery_log
+from recipients import add_suppressions
+
+
+load_dotenv()
+
+# Units of work in flight per provider, across every sending thread in the process
+PROVIDER_CONCURRENCY = {
+    "SMTP": int(os.getenv("SMTP_CONCURRENCY", "4")),
+    "Gmail API": int(os.getenv("GMAIL_CONCURRENCY", "8")),
+    # Each Graph $batch already runs GRAPH_MAILBOX_CONCURRENCY requests against the one mailbox
+    "outlook": int(os.getenv("OUTLOOK_CONCURRENCY", "1")),
+}
+# Unit senders take a list of (recipient, subject, body), so merged messages can differ per recipient
+# Recipients handled by one unit of work (one pooled SMTP session run, one Gmail batch, one Graph $batch)
+PROVIDER_UNIT_SIZE = {
+    "SMTP": int(os.getenv("SMTP_UNIT_SIZE", "10")),
+    "Gmail API": GMAIL_BATCH_SIZE,
+    "outlook": GRAPH_BATCH_SIZE,
+}
+# Held around every provider call, so outbox workers, campaigns and the scheduler share the limits
+_provider_slots = {provider: threading.BoundedSemaphore(limit) for provider, limit in PROVIDER_CONCURRENCY.items()}
+# One long-lived thread pool per provider, created on first use and shared by every campaign
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def split_recipients(addresses):
+    """Turn a comma separated address string into a list of stripped addresses."""
+    return [email.strip() for email in (addresses or "").split(",") if email.strip()]
+
+
+def _sent(detail=None):
+    return {"status": "sent", "detail": detail}
+
+
+def _failed(detail, code=None, retry_after=None, transient=None, recipient_only=False):
+    """A failed result. code (SMTP reply code or HTTP status) tells transient errors from
+    permanent ones, unless the sender already knows and passes transient. recipient_only
+    marks an SMTP RCPT reply about that one address, which never slows the provider down."""
+    result = {"status": "failed", "detail": detail, "code": code, "retry_after": retry_after}
+    if transient is not None:
+        result["transient"] = transient
+    if recipient_only:
+        result["recipient_only"] = True
+    return result
+
+
+def _deferred(retry_after):
+    """Not attempted because a quota ran out; detail is the seconds until it can be retried."""
+    return {"status": "deferred", "detail": retry_after}
+
+
+def _suppress_bounces(replies):
+    """Suppress addresses the SMTP server rejected as nonexistent, so later sends skip them."""
+    bounced = [recipient for recipient, (code, resp) in replies.items() if is_hard_bounce(code, resp)]
+    if not bounced:
+        return
+    try:
+        add_suppressions(bounced, "bounced")
+    except sqlite3.Error as e:
+        # Don't let bookkeeping turn a finished send into a failed (and retried) one
+        print(f"Error suppressing {len(bounced)} bounced addresses: {e}")
+
+
+def _send_smtp_unit(messages, reply_to, signature):
+    from_email = os.getenv('EMAIL_USER')  # SMTP email
+    from_password = os.getenv('EMAIL_PASS')  # Email password
+    # The body is encoded once per distinct subject/body; each copy only adds its To header
+    envelopes = (
+        ([recipient], shared_message(from_email, subject, body, reply_to, signature).as_bytes([recipient]))
+        for recipient, subject, body in messages
+    )
+    replies = get_smtp_pool(from_email, from_password).send_batch(from_email, envelopes)
+    _suppress_bounces(replies)
+    subjects = {recipient: subject for recipient, subject, _ in messages}
+    # Failures may still be retried; the outbox logs them once they are final (record_undelivered)
+    delivery_log.record_many(
+        (from_email, recipient, subjects[recipient], None, "Sent", None)
+        for recipient, (code, _) in replies.items() if code in ACCEPTED_CODES
+    )
+    return {
+        recipient: _sent(resp) if code in ACCEPTED_CODES
+        else _failed(f"{code} {resp}", code, recipient_only=recipient not in replies.envelope)
+        for recipient, (code, resp) in replies.items()
+    }
+
+
+def _send_gmail_unit(messages, reply_to, signature):
+    service = gmail_client.service()
+    if service is None:
+        return {recipient: _failed("Gmail authorization required.") for recipient, _, _ in messages}
+    sender_email = gmail_client.sender_email(service)
+    raw_messages = [
+        (recipient, shared_message(sender_email, subject, body, reply_to, signature).gmail_raw([recipient]))
+        for recipient, subject, body in messages
+    ]
+    subjects = {recipient: subject for recipient, subject, _ in messages}
+    results = deliver_gmail_messages(service, sender_email, None, raw_messages, subjects)
+    return {
+        recipient: _sent(result['id']) if 'id' in result
+        else _failed(result['error'], result.get('code'), result.get('retry_after'))
+        for recipient, result in results.items()
+    }
+
+
+def _send_outlook_unit(messages, reply_to, signature):
+    emails = [(recipient, subject, body + "\n\n" + signature if signature else body) for recipient, subject, body in messages]
+    results = send_emails_via_outlook_batch(emails)
+    if results is None:
+        return {recipient: _failed("Outlook authorization required.") for recipient, _, _ in messages}
+    return {
+        recipient: _sent() if result["status"] == "success"
+        else _failed(f"{result['error_code']} - {result['error_message']}", result['error_code'], result.get('retry_after'))
+        for (recipient, _, _), result in zip(messages, results)
+    }
+
+
+def _sender_address(provider):
+    if provider == "SMTP":
+        return os.getenv('EMAIL_USER')
+    if provider == "outlook":
+        return SENDER_EMAIL
+    service = gmail_client.service()
+    return gmail_client.sender_email(service) if service is not None else None
+
+
+def record_undelivered(provider, undelivered):
+    """Log (recipient, subject) pairs whose send failed for good to sent_emails as "not delivered".
+
+    The transports only log successes, since a failed send may still be
+    retried; callers that own the retries log a failure here once it is
+    final (a permanent error, or a transient one out of attempts).
+    """
+    undelivered = list(undelivered)
+    if not undelivered:
+        return
+    sender = _sender_address(provider)
+    delivery_log.record_many((sender, recipient, subject, None, "not delivered", None) for recipient, subject in undelivered)
+
+
+def _adapt_rate(provider, results):
+    """Feed the outcome of a send back into the provider's adaptive rate.
+
+    A 4xx to a single RCPT (greylisting, a full mailbox) is only retried for
+    that recipient; throttling is judged on session and envelope replies.
+    """
+    throttles = [result for result in results.values()
+                 if result["status"] == "failed" and not result.get("recipient_only")
+                 and is_throttle(provider, result.get("code"), result["detail"])]
+    if throttles:
+        rate_limiter.throttled(provider, max((r["retry_after"] or 0) for r in throttles))
+    elif any(result["status"] == "sent" for result in results.values()):
+        rate_limiter.recovered(provider)
+
+
+PROVIDER_SENDERS = {
+    "SMTP": _send_smtp_unit,
+    "Gmail API": _send_gmail_unit,
+    "outlook": _send_outlook_unit,
+}
+
+
+def send_unit(provider, user_id, messages, reply_to=None, signature="", partial=True):
+    """Send a unit of individual (recipient, subject, body) messages within the rate limits.
+
+    Recipients beyond what today's quotas allow (all of them if partial is
+    False) come back as deferred instead of being sent; budget reserved for
+    failed sends is refunded.
+    """
+    granted, retry_after = rate_limiter.acquire(provider, user_id, len(messages), partial)
+    recipients = [recipient for recipient, _, _ in messages]
+    results = {recipient: _deferred(retry_after) for recipient in recipients[granted:]}
+    if granted:
+        try:
+            with _provider_slots[provider]:
+                results.update(PROVIDER_SENDERS[provider](messages[:granted], reply_to, signature))
+        except Exception as e:
+            rate_limiter.refund(provider, user_id, granted)
+            if is_throttle_exception(provider, e):
+                rate_limiter.throttled(provider)
+            raise
+        _adapt_rate(provider, results)
+        rate_limiter.refund(provider, user_id, sum(1 for r in recipients[:granted] if results.get(r, {}).get("status") != "sent"))
+    return results
+
+
+def send_shared(provider, subject, body, to, cc, bcc, reply_to=None, signature="", user_id=None):
+    """Send one message to all of to/cc/bcc, the way the non-individual dashboard modes do.
+
+    Returns per-recipient results in the same shape as the unit senders.
+    Gmail API has no shared mode and sends individual copies instead. A
+    message is only sent if today's quotas cover all of its recipients;
+    otherwise every recipient is deferred.
+    """
+    all_recipients = split_recipients(to) + split_recipients(cc) + split_recipients(bcc)
+
+    if len(all_recipients) > rate_limiter.daily_limit(provider, user_id):
+        # Would never fit in a day's quota, so deferring it would only postpone the failure
+        return {recipient: _failed("Message has more recipients than the daily limit.", transient=False)
+                for recipient in all_recipients}
+    if provider not in ("SMTP", "outlook"):
+        messages = [(recipient, subject, body) for recipient in all_recipients]
+        return send_unit(provider, user_id, messages, reply_to, signature, partial=False)
+    granted, retry_after = rate_limiter.acquire(provider, user_id, len(all_recipients), partial=False)
+    if not granted and all_recipients:
+        return {recipient: _deferred(retry_after) for recipient in all_recipients}
+    try:
+        with _provider_slots[provider]:
+            results = _send_shared_message(provider, subject, body, to, cc, bcc, reply_to, signature)
+    except Exception as e:
+        rate_limiter.refund(provider, user_id, granted)
+        if is_throttle_exception(provider, e):
+            rate_limiter.throttled(provider)
+        raise
+    _adapt_rate(provider, results)
+    rate_limiter.refund(provider, user_id, sum(1 for result in results.values() if result["status"] != "sent"))
+    return results
+
+
+def _send_shared_message(provider, subject, body, to, cc, bcc, reply_to, signature):
+    """One SMTP or Outlook message to all of to/cc/bcc, without rate limiting."""
+    to_recipients = split_recipients(to)
+    cc_recipients = split_recipients(cc)
+    all_recipients = to_recipients + cc_recipients + split_recipients(bcc)
+
+    if provider == "SMTP":
+        from_email = os.getenv('EMAIL_USER')  # SMTP email
+        from_password = os.getenv('EMAIL_PASS')  # Email password
+        msg = shared_message(from_email, subject, body, reply_to, signature).as_bytes(to_recipients, cc_recipients)
+        pool = get_smtp_pool(from_email, from_password)
+        results = {}
+        refused_all = {}
+        for chunk in chunk_recipients(all_recipients):
+            try:
+                refused = pool.sendmail(from_email, chunk, msg)
+            except Exception as e:
+                if not results:
+                    raise
+                # Earlier chunks already went out: fail this one rather than have the whole message resent
+                transient, _ = classify_exception("SMTP", e)
+                for recipient in chunk:
+                    results[recipient] = _failed(str(e), getattr(e, "smtp_code", None), transient=transient)
+                continue
+            refused_all.update(refused)
+            for recipient in chunk:
+                if recipient in refused:
+                    code, resp = refused[recipient]
+                    # sendmail raises for MAIL FROM and DATA, so these are all RCPT replies
+                    results[recipient] = _failed(f"{code} {resp}", code, recipient_only=True)
+                else:
+                    results[recipient] = _sent()
+        _suppress_bounces(refused_all)
+        delivery_log.record_many(
+            (from_email, recipient, subject, None, "Sent", None)
+            for recipient, result in results.items() if result["status"] == "sent"
+        )
+        return results
+    if provider == "outlook":
+        full_body = body + "\n\n" + signature if signature else body
+        result = send_email_via_outlook(to, subject, full_body, cc, bcc)
+        if result is None:
+            outcome = _failed("Outlook authorization required.")
+        elif result["status"] == "success":
+            outcome = _sent()
+        else:
+            outcome = _failed(f"{result['error_code']} - {result['error_message']}", result['error_code'], result.get('retry_after'))
+        return {recipient: outcome for recipient in all_recipients}
+
+
+def _provider_executor(provider):
+    """The provider's shared send thread pool, sized to its concurrency limit."""
+    with _executors_lock:
+        executor = _executors.get(provider)
+        if executor is None:
+            executor = _executors[provider] = ThreadPoolExecutor(max_workers=PROVIDER_CONCURRENCY[provider],
+                                                                 thread_name_prefix=f"send-{provider}")
+        return executor
+
+
+async def send_campaign(provider, messages, reply_to=None, signature="", progress=None, user_id=None):
+    """Send individual (recipient, subject, body) messages with bounded concurrency per provider.
+
+    Messages are split into provider-sized units that run in parallel, at
+    most PROVIDER_CONCURRENCY[provider] at a time (the limit is shared with
+    every other sender in the process), on top of the pooled transports and
+    within the rate limits. progress(done, total) is called on the event
+    loop thread as units finish. A unit that raises comes back as failed,
+    classified as transient or not. Returns a dict of recipient ->
+    {'status': 'sent'|'failed'|'deferred', 'detail': ...}; callers record
+    the sent counts.
+    """
+    if provider not in PROVIDER_SENDERS:
+        raise ValueError(f"Unknown provider: {provider}")
+    size = PROVIDER_UNIT_SIZE[provider]
+    executor = _provider_executor(provider)
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY[provider])
+    results = {}
+    total = len(messages)
+    done = 0
+
+    async def run(unit):
+        nonlocal done
+        async with semaphore:
+            try:
+                unit_results = await loop.run_in_executor(
+                    executor, send_unit, provider, user_id, unit, reply_to, signature
+                )
+            except Exception as e:
+                transient, retry_after = classify_exception(provider, e)
+                unit_results = {recipient: _failed(str(e), retry_after=retry_after, transient=transient)
+                                for recipient, _, _ in unit}
+        results.update(unit_results)
+        done += len(unit)
+        if progress:
+            progress(done, total)
+
+    await asyncio.gather(*(run(messages[i:i + size]) for i in range(0, total, size)))
+    return results
+
+
+def run_campaign(provider, messages, reply_to=None, signature="", progress=None, user_id=None):
+    """Blocking wrapper around send_campaign for callers without an event loop (the outbox workers)."""
+    return asyncio.run(send_campaign(provider, messages, reply_to, signature, progress, user_id))
@@ -0,0 +1,293 @@
+import os
+import smtplib
+import threading
+import time
+from collections import deque
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_TIMEOUT = int(os.getenv("SMTP_TIMEOUT", "30"))  # seconds
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))  # open sessions per host/account
+SMTP_MAX_MESSAGES_PER_SESSION = int(os.getenv("SMTP_MAX_MESSAGES_PER_SESSION", "100"))
+SMTP_MAX_RECIPIENTS_PER_MESSAGE = int(os.getenv("SMTP_MAX_RECIPIENTS_PER_MESSAGE", "100"))
+SMTP_KEEPALIVE_INTERVAL = int(os.getenv("SMTP_KEEPALIVE_INTERVAL", "30"))  # seconds between NOOPs
+SMTP_MAX_IDLE = int(os.getenv("SMTP_MAX_IDLE", "300"))  # close sessions unused for this long
+
+# Reply codes meaning the server is closing (or has closed) the session
+RECONNECT_CODES = (421,)
+# RCPT TO reply codes meaning the recipient was accepted
+ACCEPTED_CODES = (250, 251)
+
+
+def chunk_recipients(recipients, size=SMTP_MAX_RECIPIENTS_PER_MESSAGE):
+    """Split a recipient list into chunks no larger than the per-message limit."""
+    for i in range(0, len(recipients), size):
+        yield recipients[i:i + size]
+
+
+def _decode(resp):
+    return resp.decode(errors="replace") if isinstance(resp, bytes) else str(resp)
+
+
+class BatchReplies(dict):
+    """Recipient -> (code, response), plus the recipients whose reply was not their own RCPT reply.
+
+    envelope holds the recipients answered for the whole session or
+    transaction (MAIL FROM, DATA, 421, a dropped connection), which say
+    something about the server's state rather than about one address.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.envelope = set()
+
+    def record(self, replies):
+        """Each recipient's own RCPT reply."""
+        self.update(replies)
+        self.envelope.difference_update(replies)
+
+    def fail(self, recipients, code, resp):
+        for recipient in recipients:
+            self[recipient] = (code, resp)
+        self.envelope.update(recipients)
+
+
+class PooledSMTPSession:
+    """An authenticated SMTP session owned by a connection pool."""
+
+    def __init__(self, host, port, user, password):
+        self.server = smtplib.SMTP(host, port, timeout=SMTP_TIMEOUT)
+        self.server.starttls()  # Secure the connection
+        self.server.login(user, password)
+        self.messages_sent = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def is_alive(self):
+        """Check the session with a NOOP; False if the server dropped it."""
+        try:
+            code, _ = self.server.noop()
+            return code == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SMTPConnectionPool:
+    """Thread-safe pool of authenticated SMTP sessions for one host and account."""
+
+    def __init__(self, host, port, user, password, max_size=SMTP_POOL_SIZE,
+                 max_messages_per_session=SMTP_MAX_MESSAGES_PER_SESSION):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_messages_per_session = max_messages_per_session
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self):
+        return PooledSMTPSession(self.host, self.port, self.user, self.password)
+
+    def acquire(self):
+        """Take a warm session from the pool, opening a new one if none is idle."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    session = self._idle.pop() if self._idle else None
+                if session is None:
+                    return self._connect()
+                # Sessions that sat idle past a keepalive interval get checked first
+                if time.monotonic() - session.last_used < SMTP_KEEPALIVE_INTERVAL or session.is_alive():
+                    return session
+                session.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, session, discard=False):
+        """Return a session to the pool, closing it if broken or used up."""
+        try:
+            session.last_used = time.monotonic()
+            if discard or session.messages_sent >= self.max_messages_per_session:
+                session.close()
+            else:
+                with self._lock:
+                    self._idle.append(session)
+        finally:
+            self._slots.release()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Send one message, reconnecting once if the session was dropped or closed with 421.
+
+        Returns the refused recipients as {address: (code, response)}, every
+        one of them if the server accepted none, with responses decoded to
+        text as send_batch returns them.
+        """
+        for attempt in range(2):
+            session = self.acquire()
+            try:
+                refused = session.server.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPRecipientsRefused as e:
+                # smtplib already reset the transaction, so the session is still good
+                self.release(session)
+                return {address: (code, _decode(resp)) for address, (code, resp) in e.recipients.items()}
+            except smtplib.SMTPServerDisconnected:
+                self.release(session, discard=True)
+                if attempt:
+                    raise
+                continue
+            except smtplib.SMTPResponseException as e:
+                self.release(session, discard=True)
+                if attempt or e.smtp_code not in RECONNECT_CODES:
+                    raise
+                continue
+            except Exception:
+                self.release(session, discard=True)
+                raise
+            session.messages_sent += 1
+            self.release(session)
+            return {address: (code, _decode(resp)) for address, (code, resp) in refused.items()}
+
+    def _send_envelope(self, session, from_addr, recipients, msg, results):
+        """Run MAIL/RCPT/DATA for one message, recording each RCPT reply in results."""
+        server = session.server
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(from_addr)
+        if code in RECONNECT_CODES:
+            raise smtplib.SMTPServerDisconnected(_decode(resp))
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        replies = {}
+        for recipient in recipients:
+            code, resp = server.rcpt(recipient)
+            if code in RECONNECT_CODES:
+                raise smtplib.SMTPServerDisconnected(_decode(resp))
+            replies[recipient] = (code, _decode(resp))
+        accepted = [r for r, (code, _) in replies.items() if code in ACCEPTED_CODES]
+
+        if accepted:
+            try:
+                code, resp = server.data(msg)
+            except smtplib.SMTPResponseException as e:
+                # DATA was answered with something other than 354: close the open MAIL FROM transaction
+                code, resp = e.smtp_code, e.smtp_error
+                if code not in RECONNECT_CODES:
+                    server.rset()
+            if code in RECONNECT_CODES:
+                raise smtplib.SMTPServerDisconnected(_decode(resp))
+            session.messages_sent += 1
+            if code != 250:
+                # The message itself was rejected, so no accepted recipient got it
+                results.record(replies)
+                results.fail(accepted, code, _decode(resp))
+                return
+        else:
+            server.rset()
+        results.record(replies)
+
+    def send_batch(self, from_addr, messages):
+        """Stream (recipients, msg) pairs over as few sessions as possible.
+
+        Each message's recipients are chunked to the per-message limit and a
+        session is swapped out once it reaches the per-session limit. Returns a
+        BatchReplies mapping every recipient to its (code, response) so that a
+        rejected address doesn't fail the rest of the batch.
+        """
+        results = BatchReplies()
+        session = None
+        try:
+            for recipients, msg in messages:
+                for chunk in chunk_recipients(list(recipients)):
+                    for attempt in range(2):
+                        if session is None:
+                            session = self.acquire()
+                        try:
+                            self._send_envelope(session, from_addr, chunk, msg, results)
+                            break
+                        except (smtplib.SMTPServerDisconnected, OSError) as e:
+                            self.release(session, discard=True)
+                            session = None
+                            if attempt:
+                                results.fail(chunk, 421, str(e))
+                        except smtplib.SMTPSenderRefused as e:
+                            results.fail(chunk, e.smtp_code, _decode(e.smtp_error))
+                            break
+                        except smtplib.SMTPResponseException as e:
+                            # Any other unexpected reply leaves the session in an unknown state
+                            self.release(session, discard=True)
+                            session = None
+                            results.fail(chunk, e.smtp_code, _decode(e.smtp_error))
+                            break
+                    if session is not None and session.messages_sent >= self.max_messages_per_session:
+                        self.release(session)
+                        session = None
+        except BaseException:
+            # Don't hand a session in the middle of a transaction back to the pool
+            if session is not None:
+                self.release(session, discard=True)
+                session = None
+            raise
+        finally:
+            if session is not None:
+                self.release(session)
+        return results
+
+    def keepalive(self):
+        """NOOP idle sessions to keep them warm and drop dead or stale ones."""
+        with self._lock:
+            sessions = list(self._idle)
+            self._idle.clear()
+        now = time.monotonic()
+        keep = []
+        for session in sessions:
+            if now - session.last_used > SMTP_MAX_IDLE or not session.is_alive():
+                session.close()
+            else:
+                keep.append(session)
+        with self._lock:
+            self._idle.extend(keep)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_keepalive_thread = None
+
+
+def _keepalive_loop():
+    while True:
+        time.sleep(SMTP_KEEPALIVE_INTERVAL)
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            try:
+                pool.keepalive()
+            except Exception as e:
+                print(f"SMTP keepalive error for {pool.user}@{pool.host}: {e}")
+
+
+def get_smtp_pool(user, password, host=SMTP_HOST, port=SMTP_PORT):
+    """Return the process-wide pool for this host and account, creating it on first use."""
+    global _keepalive_thread
+    key = (host, port, user, password)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SMTPConnectionPool(host, port, user, password)
+        if _keepalive_thread is None:
+            _keepalive_thread = threading.Thread(target=_keepalive_loop, daemon=True)
+            _keepalive_thread.start()
+    return pool
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from jinja2 import TemplateSyntaxError
+from db import connection, QUERY_CACHE_TTL
+from mail_merge import get_compiled
+
+
+load_dotenv()
+
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "64"))  # full template records kept in memory
+
+# Rows have the same shape as SELECT * FROM templates
+TEMPLATE_COLUMNS = "template_id, template_name, subject, body, created_by, version"
+
+
+class TemplateStore:
+    """Process-wide cache in front of the templates table, shared by every session.
+
+    Full records are kept in an LRU of TEMPLATE_CACHE_SIZE entries, each
+    stamped with the template's version and its body pre-compiled for mail
+    merge (under the same (id, version) key mail_merge uses when sending).
+    The id/name listing for pickers is cached separately, so showing the
+    list never loads template bodies. Writes made through the store drop
+    the affected entries; entries also expire after QUERY_CACHE_TTL seconds
+    to pick up edits from other processes.
+    """
+
+    def __init__(self, size=TEMPLATE_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._records = OrderedDict()  # template_id -> (row, loaded_at)
+        self._names = None  # ([(template_id, template_name)], loaded_at)
+        self._lock = threading.Lock()
+
+    def _fresh(self, loaded_at):
+        return time.monotonic() - loaded_at < self.ttl
+
+    def list_names(self):
+        """[(template_id, template_name)] for every template, without subjects or bodies."""
+        with self._lock:
+            if self._names is not None and self._fresh(self._names[1]):
+                return list(self._names[0])
+        with connection() as conn:
+            names = conn.execute("SELECT template_id, template_name FROM templates ORDER BY template_id").fetchall()
+        with self._lock:
+            self._names = (names, time.monotonic())
+        return list(names)
+
+    def get(self, template_id):
+        """The template's row (id, name, subject, body, created_by, version), or None."""
+        with self._lock:
+            entry = self._records.get(template_id)
+            if entry is not None and self._fresh(entry[1]):
+                self._records.move_to_end(template_id)
+                return entry[0]
+        with connection() as conn:
+            row = conn.execute(f"SELECT {TEMPLATE_COLUMNS} FROM templates WHERE template_id = ?", (template_id,)).fetchone()
+        if row is None:
+            self.invalidate(template_id)
+            return None
+        try:
+            # Pre-parse now so the send path finds it compiled
+            get_compiled(row[2], row[3], row[0], row[5])
+        except TemplateSyntaxError:
+            pass  # reported to the user by missing_variables before sending
+        with self._lock:
+            self._records[template_id] = (row, time.monotonic())
+            self._records.move_to_end(template_id)
+            while len(self._records) > self.size:
+                self._records.popitem(last=False)
+        return row
+
+    def invalidate(self, template_id=None):
+        """Forget the listing and, if given, one template's record."""
+        with self._lock:
+            self._names = None
+            if template_id is not None:
+                self._records.pop(template_id, None)
+
+    def add(self, name, subject, body, created_by):
+        with connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO templates (template_name, subject, body, created_by) VALUES (?, ?, ?, ?)",
+                (name, subject, body, created_by),
+            )
+        self.invalidate()
+        return cursor.lastrowid
+
+    def edit(self, template_id, name, subject, body):
+        # The version bump gives the edited template a new mail merge cache key
+        with connection() as conn:
+            conn.execute(
+                "UPDATE templates SET template_name = ?, subject = ?, body = ?, version = version + 1 WHERE template_id = ?",
+                (name, subject, body, template_id),
+            )
+        self.invalidate(template_id)
+
+    def delete(self, template_id):
+        with connection() as conn:
+            conn.execute("DELETE FROM templates WHERE template_id = ?", (template_id,))
+        self.invalidate(template_id)
+
+
+template_store = TemplateStore()
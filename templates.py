@@ -1,62 +1,23 @@
 import MassMail
 import streamlit as st
-import sqlite3
-
-conn = sqlite3.connect('mass_mail.db')
-cursor = conn.cursor()
-
-# Create template table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS templates (
-    template_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    template_name TEXT NOT NULL,
-    subject TEXT NOT NULL,
-    body TEXT NOT NULL,
-    created_by TEXT NOT NULL
-)
-''')
-
-conn.commit()
-conn.close()
-def get_templates():
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM templates')
-    templates = cursor.fetchall()
-    conn.close()
-    return templates
+from template_store import template_store
+
+# Templates are read and written through the shared template store, which caches them across sessions
+def get_template_names():
+    return template_store.list_names()
 user_id = st.session_state.get('user_id', None)
 
 def add_template(name, subject, body, user):
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO templates (template_name, subject, body, created_by) VALUES (?, ?, ?, ?)', 
-                   (name, subject, body, user))
-    conn.commit()
-    conn.close()
+    template_store.add(name, subject, body, user)
 
 def edit_template(template_id, name, subject, body):
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE templates SET template_name=?, subject=?, body=? WHERE template_id=?', 
-                   (name, subject, body, template_id))
-    conn.commit()
-    conn.close()
+    template_store.edit(template_id, name, subject, body)
 
 def delete_template(template_id):
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM templates WHERE template_id=?', (template_id,))
-    conn.commit()
-    conn.close()
+    template_store.delete(template_id)
 
 def get_template_by_id(template_id):
-    conn = sqlite3.connect('mass_mail.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM templates WHERE template_id=?', (template_id,))
-    template = cursor.fetchone()
-    conn.close()
-    return template
+    return template_store.get(template_id)
 
 # Function to navigate between pages
 def switch_page(page_name):
@@ -86,13 +47,12 @@ def template_management():
 
     # Edit or Delete Templates
     st.header("Manage Existing Templates")
-    templates = get_templates()
-    template_options = [f"{template[1]} - {template[2]}" for template in templates]
-    template_id = st.selectbox("Select Template to Edit/Delete", [template[0] for template in templates], format_func=lambda x: template_options[x-1] if x > 0 else "None")
+    template_names = dict(get_template_names())
+    template_id = st.selectbox("Select Template to Edit/Delete", list(template_names), format_func=lambda x: template_names.get(x, "None"))
 
 
     if template_id:
-        template = next(t for t in templates if t[0] == template_id)
+        template = get_template_by_id(template_id)
         name = st.text_input("Template Name", value=template[1])
         subject = st.text_input("Subject", value=template[2])
         body = st.text_area("Body", value=template[3])